@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import glob
+import json
+import locale
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+from helper.instrumentation import peak_rss_mb
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark():
+    """ collects wall time, throughput and memory of benchmark stages
+
+    Every stage is measured by the stage context manager, the result dictionary can be stored
+    as json and compared against a stored baseline.
+
+    Memory: the peak RSS of the process can only grow, so it is stored once for the run (meta 'peak_rss_mb').
+    A stage records 'peak_rss_increase_mb', how far it raised that peak (0 if it stayed below the peak of
+    an earlier stage, so it is a lower bound of the memory the stage needed). The traced python
+    allocations ('peak_traced_mb', trace_memory) are measured per stage.
+    """
+
+    def __init__(self, trace_memory:bool=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.meta = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        }
+
+    @contextmanager
+    def stage(self, name:str, unit:str='items', trace_memory:bool=None):
+        """ measures the enclosed block
+
+        The block gets a dictionary to fill in 'items' (amount of processed units) and
+        'breakdown' (sub stage name -> seconds)
+        trace_memory overrides the setting of the benchmark for this stage
+
+        Example
+        -------
+            with benchmark.stage('sentiws', unit='articles') as stage:
+                ...
+                stage['items'] = len(df)
+        """
+        stage = {'items': 0, 'unit': unit, 'breakdown': {}}
+        if trace_memory is None:
+            trace_memory = self.trace_memory
+        if trace_memory:
+            tracemalloc.start()
+        print(f'Running stage {name}')
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield stage
+        except Exception as e:
+            stage['error'] = f'{type(e).__name__}: {e}'
+            print(f'Stage {name} failed: {stage["error"]}')
+        wall = time.perf_counter() - start
+        stage['wall_s'] = wall
+        stage['throughput'] = stage['items'] / wall if wall > 0 and stage['items'] else None
+        rss_after = peak_rss_mb()
+        stage['peak_rss_increase_mb'] = rss_after - rss_before if rss_after is not None else None
+        if trace_memory:
+            stage['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        self.stages[name] = stage
+        throughput = f", {stage['throughput']:.2f} {unit}/s" if stage['throughput'] else ''
+        print(f'Stage {name}: {wall:.2f}s{throughput}')
+
+    def to_dict(self) -> dict:
+        return {'meta': dict(self.meta, peak_rss_mb=peak_rss_mb()), 'stages': self.stages}
+
+    def save(self, file_name:str):
+        with open(file_name, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        print(f'Results stored in {file_name}')
+
+    @staticmethod
+    def compare(results:dict, baseline:dict, tolerance:float=0.10) -> list:
+        """ prints the comparison of the results with a baseline
+
+        Parameters
+        ----------
+        results: dict
+            the current results (Benchmark.to_dict)
+        baseline: dict
+            the stored baseline
+        tolerance: float
+            relative slow down of the wall time that is still accepted
+
+        Returns
+        -------
+        list
+            names of the stages that got slower than the tolerance
+        """
+        regressions = []
+        print(f"{'stage':<32} {'baseline s':>12} {'current s':>12} {'ratio':>8}")
+        for name, stage in results['stages'].items():
+            base = baseline.get('stages', {}).get(name)
+            if base is None or 'error' in stage or 'error' in base:
+                print(f"{name:<32} {'-':>12} {stage['wall_s']:>12.3f} {'-':>8}")
+                continue
+            ratio = stage['wall_s'] / base['wall_s'] if base['wall_s'] > 0 else float('nan')
+            marker = ''
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+                marker = '  SLOWER'
+            elif ratio < 1 - tolerance:
+                marker = '  faster'
+            print(f"{name:<32} {base['wall_s']:>12.3f} {stage['wall_s']:>12.3f} {ratio:>8.2f}{marker}")
+        return regressions
+
+
+def load_corpus(benchmark:Benchmark, directory_name:str) -> pd.DataFrame:
+    """ reads all pdf files of the directory, measured per pdf (stage ingest) """
+    from helper.pdf_news_reader import PdfNewsReader
+
+    try:
+        locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
+    except locale.Error:
+        print('Locale de_DE.UTF-8 not available, dates of the articles might not be parsed')
+
+    pdf_files = []
+    for pdf_path in sorted(glob.glob(os.path.join(directory_name, '*.pdf')) + glob.glob(os.path.join(directory_name, '*.PDF'))):
+        # naming convention of process_all_newspaper_articles: <year>_<newspaper>_<part>
+        match = re.match(r'^(\d{4})_([A-Z]+)_(\d+)$', os.path.splitext(os.path.basename(pdf_path))[0])
+        if match:
+            pdf_files.append((pdf_path, match.groups()))
+        else:
+            print(f'Skipping {pdf_path}, name does not match <year>_<newspaper>_<part>')
+    if not pdf_files:
+        raise ValueError(f'No pdf files named <year>_<newspaper>_<part> in {directory_name}')
+
+    dataframes = []
+    with benchmark.stage('ingest', unit='pdfs') as stage:
+        for pdf_path, (year, newspaper, part) in pdf_files:
+            start = time.perf_counter()
+            df = PdfNewsReader.extract_texts_to_df(pdf_path)
+            stage['breakdown'][os.path.basename(pdf_path)] = time.perf_counter() - start
+            df['Newspaper'] = newspaper
+            df['Part'] = f'{year}_{newspaper}_{part}'
+            dataframes.append(df)
+        stage['items'] = len(pdf_files)
+
+    df = pd.concat(dataframes, ignore_index=True)
+    df['Publication Date'] = pd.to_datetime(df['Publication Date'])
+    df['Year'] = df['Publication Date'].dt.year
+    benchmark.stages['ingest']['articles'] = len(df)
+    return df
+
+
+def scale_corpus(df:pd.DataFrame, scale:int) -> pd.DataFrame:
+    """ returns a synthetic corpus containing every article scale times """
+    return pd.concat([df] * scale, ignore_index=True)
+
+
+def run_sentiws(benchmark:Benchmark, df:pd.DataFrame, name:str):
+    from helper.sentiws_metric import SentiWS_Metric
+    SentiWS_Metric.getInstance()
+    with benchmark.stage(f'sentiws[{name}]', unit='articles') as stage:
+        for text in df['Extracted Text']:
+            SentiWS_Metric.analyze_sentiment_ws_text(text)
+        stage['items'] = len(df)
+
+
+def run_bert(benchmark:Benchmark, df:pd.DataFrame, name:str, sample:int, batch_size:int, processes:int=None):
+    """ per article, batched and multi-process (calculate_sentiment_parallel) scoring of the same sample """
+    from helper.sentiment_bert import SentimentBert
+    texts = df['Extracted Text'].dropna().tolist()[:sample]
+    with benchmark.stage(f'bert_article[{name}]', unit='articles') as stage:
+        for text in texts:
+            SentimentBert.sentiment_pipeline(text)
+        stage['items'] = len(texts)
+    with benchmark.stage(f'bert_batch[{name}]', unit='articles') as stage:
+        SentimentBert.sentiment_pipeline(texts, batch_size=batch_size)
+        stage['items'] = len(texts)
+    # includes starting the worker processes and loading the model in every worker
+    with benchmark.stage(f'bert_parallel[{name}]', unit='articles') as stage:
+        sample_df = pd.DataFrame({'Extracted Text': texts})
+        SentimentBert.calculate_sentiment_parallel(sample_df, 'Extracted Text', 'Sentiment', processes=processes, batch_size=batch_size)
+        stage['items'] = len(texts)
+    batch, parallel = benchmark.stages[f'bert_batch[{name}]'], benchmark.stages[f'bert_parallel[{name}]']
+    if 'error' not in batch and 'error' not in parallel and parallel['wall_s'] > 0:
+        parallel['speedup_vs_batch'] = batch['wall_s'] / parallel['wall_s']
+        print(f"bert_parallel[{name}]: {parallel['speedup_vs_batch']:.2f}x of bert_batch")
+
+
+def run_tfidf(benchmark:Benchmark, df:pd.DataFrame, name:str):
+    from helper.tfidf_helper import top_tfidf_terms
+    # the calls of the notebook
+    slices = [('ALL', [year]) for year in sorted(df['Year'].dropna().unique())] + [(newspaper, 'ALL') for newspaper in sorted(df['Newspaper'].unique())]
+    with benchmark.stage(f'tfidf[{name}]', unit='slices') as stage:
+        for newspaper, years in slices:
+            start = time.perf_counter()
+            top_tfidf_terms(df, newspaper, years, 20)
+            stage['breakdown'][f'{newspaper}/{years}'] = time.perf_counter() - start
+        stage['items'] = len(slices)
+
+
+def run_tfidf_memory(benchmark:Benchmark, df:pd.DataFrame, name:str, top_n:int=20):
+    """ compares the memory of the former dense top term calculation with the sparse batch of CorpusTfidf """
+    from helper.tfidf_helper import CorpusTfidf
+    corpus = CorpusTfidf(df)
+    slices = corpus.all_slices()
+    with benchmark.stage(f'tfidf_dense[{name}]', unit='slices', trace_memory=True) as stage:
+        for newspaper, years in slices:
+            # former top_tfidf_terms: dense matrix of the slice, all terms sorted
+            means = corpus.matrix[corpus.rows(newspaper, years)].todense().mean(axis=0).tolist()[0]
+            sorted(zip(corpus.feature_names, means), key=lambda x: x[1], reverse=True)[:top_n]
+        stage['items'] = len(slices)
+    with benchmark.stage(f'tfidf_sparse[{name}]', unit='slices', trace_memory=True) as stage:
+        corpus.top_terms_batch(slices, top_n)
+        stage['items'] = len(slices)
+    benchmark.stages[f'tfidf_sparse[{name}]']['terms'] = len(corpus.feature_names)
+
+
+def run_word2vec(benchmark:Benchmark, df:pd.DataFrame, name:str, word:str):
+    from helper import word2vec_helper
+    # measure the training: no models from memory or from the cache directory
+    word2vec_helper._models.clear()
+    with benchmark.stage(f'word2vec[{name}]', unit='articles') as stage:
+        word2vec_helper.find_similar_words(df, 'ALL', 'ALL', word, cache_dir=None)
+        stage['items'] = len(df)
+
+
+STAGES = ['sentiws', 'bert', 'tfidf', 'tfidf_memory', 'word2vec']
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of ingestion and the scorers on a fixed corpus')
+    parser.add_argument('--corpus', default='ShortNewsArtikel', help='directory with the pdf files')
+    parser.add_argument('--scale', type=int, default=10, help='the synthetic corpus contains every article scale times (0: skip)')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'comma separated subset of {STAGES}')
+    parser.add_argument('--bert-sample', type=int, default=50, help='max amount of articles scored by BERT')
+    parser.add_argument('--bert-batch-size', type=int, default=16)
+    parser.add_argument('--bert-processes', type=int, default=None, help='worker processes of bert_parallel (default: cores / 4)')
+    parser.add_argument('--word', default='flüchtling', help='search word for Word2Vec')
+    parser.add_argument('--trace-memory', action='store_true', help='record the peak of python allocations per stage (slower)')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='compare against this file if it exists')
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as new baseline')
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    benchmark = Benchmark(trace_memory=args.trace_memory)
+    benchmark.meta['corpus'] = args.corpus
+    benchmark.meta['scale'] = args.scale
+
+    df = load_corpus(benchmark, args.corpus)
+    corpora = [('short', df)]
+    if args.scale > 1:
+        corpora.append((f'x{args.scale}', scale_corpus(df, args.scale)))
+
+    for name, corpus in corpora:
+        if 'sentiws' in stages:
+            run_sentiws(benchmark, corpus, name)
+        if 'bert' in stages:
+            run_bert(benchmark, corpus, name, args.bert_sample, args.bert_batch_size, args.bert_processes)
+        if 'tfidf' in stages:
+            run_tfidf(benchmark, corpus, name)
+        if 'tfidf_memory' in stages:
+            run_tfidf_memory(benchmark, corpus, name)
+        if 'word2vec' in stages:
+            run_word2vec(benchmark, corpus, name, args.word)
+
+    benchmark.save(args.output)
+    if args.save_baseline:
+        benchmark.save(args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        regressions = Benchmark.compare(benchmark.to_dict(), baseline, args.tolerance)
+        if regressions:
+            print(f'Slower than baseline: {", ".join(regressions)}')
+            sys.exit(1)
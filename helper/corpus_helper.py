@@ -0,0 +1,39 @@
+import re
+import numpy as np
+import pandas as pd
+
+# the sentence split of the corpus: MigText (PdfNewsReader.extract_migration_sentences),
+# sentence numbers of the inverted index and sentences of the token cache
+sentence_separator = re.compile(r'(?<=[.!?])\s+')
+
+def split_sentences(text:str) -> list:
+    ''' returns the sentences of a text '''
+    return sentence_separator.split(text)
+
+def text_hashes(df:pd.DataFrame, columns:str|list='Extracted Text') -> np.ndarray:
+    ''' returns one uint64 hash per row of the column(s), independent of the index
+
+    used to check that a stored structure (token store, inverted index, models) belongs to the texts of a dataframe
+    '''
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+def slice_mask(newspapers:np.ndarray, years_of_rows:np.ndarray, newspaper:str='ALL', years:list|str='ALL') -> np.ndarray:
+    ''' returns a mask of the rows of a newspaper and/or years
+
+    Parameters
+    ----------
+    newspapers:np.ndarray
+        the newspaper of every row
+    years_of_rows:np.ndarray
+        the year of every row
+    newspaper:str
+        either a valid newspaper or 'ALL'
+    years:list|str
+        either a list of years [2012,2013]  or 'ALL'
+    '''
+    mask = np.ones(len(newspapers), dtype=bool)
+    if newspaper != 'ALL':
+        mask &= newspapers == newspaper
+    if years != 'ALL':
+        mask &= np.isin(years_of_rows, years)
+    return mask
@@ -0,0 +1,222 @@
+import atexit
+import cProfile
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_mb() -> float:
+    """ returns the peak resident set size of the process in MB (None if not available) """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 / 1024 if platform.system() == 'Darwin' else peak / 1024
+
+
+class Progress():
+    """ counts processed items of a long running loop, prints throughput and ETA every interval seconds """
+
+    def __init__(self, tracer, name:str, total:int, interval:float):
+        self.tracer = tracer
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, n:int=1):
+        self.done += n
+        self.tracer.count(self.name, n)
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or self.done == self.total:
+            self.last_report = now
+            elapsed = now - self.start
+            rate = self.done / elapsed if elapsed > 0 else 0
+            eta = (self.total - self.done) / rate if rate > 0 and self.total else float('nan')
+            print(f"{self.name}: {self.done} of {self.total}, {rate:.2f}/s, ETA {eta:.0f}s")
+            self.tracer.event('progress', name=self.name, done=self.done, total=self.total, rate=rate, eta_s=eta)
+
+
+class _NoProgress():
+    def update(self, n:int=1):
+        pass
+
+
+class Tracer():
+    """ class to record spans, counters and progress of the helpers into a trace file
+
+    Disabled by default (spans cost nearly nothing then), enable by calling Tracer.enable or by the environment
+        MEDIA_ANALYSIS_TRACE=trace.jsonl      trace file, one json object per line
+        MEDIA_ANALYSIS_PROFILE=run.prof       additionally profile the whole run with cProfile
+
+    Every span line contains name, start, duration, parent span, process and thread id, peak RSS and attributes,
+    so the trace can be matched with an external sampling profiler (py-spy record --pid <pid>).
+    Works as a singleton, initialisation done by init function of singleton
+    """
+    __instance = None
+
+    @staticmethod
+    def getInstance():
+        # Static access method.
+        if Tracer.__instance == None:
+            Tracer()
+        return Tracer.__instance
+
+    def __init__(self):
+        # Virtually private constructor
+        if Tracer.__instance != None:
+            raise Exception("Class Tracer is a singleton!")
+        else:
+            Tracer.__instance = self
+
+        self.enabled = False
+        self.trace_file = None
+        self.counters = {}
+        self.progress_interval = 10
+        self._file = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiler = None
+
+        if os.environ.get('MEDIA_ANALYSIS_TRACE'):
+            self.enable(os.environ['MEDIA_ANALYSIS_TRACE'], os.environ.get('MEDIA_ANALYSIS_PROFILE'))
+
+    def enable(self, trace_file:str='trace.jsonl', profile_file:str=None, progress_interval:float=10):
+        """ starts recording
+
+        Parameters
+        ----------
+        trace_file:str
+            the trace file (appended)
+        profile_file:str
+            if given, the whole run is profiled by cProfile and the stats are stored in this file at exit
+            (read with pstats or snakeviz)
+        progress_interval:float
+            seconds between two progress outputs
+        """
+        self.disable()
+        self.trace_file = trace_file
+        self.progress_interval = progress_interval
+        self._file = open(trace_file, 'a', encoding='utf-8')
+        self.enabled = True
+        self.event('start', pid=os.getpid(), platform=platform.platform())
+        if profile_file:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+            atexit.register(self._dump_profile, profile_file)
+        atexit.register(self.disable)
+
+    def disable(self):
+        """ stops recording, writes the counters and closes the trace file """
+        if not self.enabled:
+            return
+        self.event('end', counters=self.counters, peak_rss_mb=peak_rss_mb())
+        self.enabled = False
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+    def _dump_profile(self, profile_file:str):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(profile_file)
+            self._profiler = None
+
+    def _write(self, record:dict):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + '\n')
+                self._file.flush()
+
+    def event(self, kind:str, **attributes):
+        """ writes one record with the current time """
+        if self.enabled:
+            self._write({'type': kind, 'time': time.time(), 'pid': os.getpid(), **attributes})
+
+    def count(self, name:str, n:int=1):
+        """ adds n to a counter (written at the end of the trace) """
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def _span(self, name:str, attributes:dict):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            self._write({'type': 'span', 'name': name, 'parent': parent, 'time': start_time, 'duration_s': duration,
+                         'pid': os.getpid(), 'thread': threading.get_ident(), 'peak_rss_mb': peak_rss_mb(), **attributes})
+
+    def span(self, name:str, **attributes):
+        """ measures the enclosed block
+
+        Attributes can also be added inside the block to the yielded dictionary
+
+        Example
+        -------
+            with Tracer.getInstance().span('pdf', path=pdf_path) as span:
+                ...
+                span['articles'] = len(df)
+        """
+        if not self.enabled:
+            return _no_span()
+        return self._span(name, attributes)
+
+    def progress(self, name:str, total:int):
+        """ returns a progress counter, call update(n) after every n processed items """
+        if not self.enabled:
+            return _NoProgress()
+        return Progress(self, name, total, self.progress_interval)
+
+    @contextmanager
+    def profile(self, profile_file:str):
+        """ profiles the enclosed block with cProfile (independent of enable), e.g. a hot path """
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+
+
+@contextmanager
+def _no_span():
+    yield {}
+
+
+def summarize(trace_file:str='trace.jsonl') -> dict:
+    """ returns count, total and max duration per span name of a trace file """
+    summary = {}
+    with open(trace_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            record = json.loads(line)
+            if record.get('type') != 'span':
+                continue
+            entry = summary.setdefault(record['name'], {'count': 0, 'total_s': 0.0, 'max_s': 0.0})
+            entry['count'] += 1
+            entry['total_s'] += record['duration_s']
+            entry['max_s'] = max(entry['max_s'], record['duration_s'])
+    return dict(sorted(summary.items(), key=lambda item: -item[1]['total_s']))
+
+
+if __name__ == "__main__":
+    import sys
+    for name, entry in summarize(sys.argv[1] if len(sys.argv) > 1 else 'trace.jsonl').items():
+        print(f"{name:<32} {entry['count']:>8} {entry['total_s']:>10.2f}s {entry['max_s']:>10.3f}s")
@@ -0,0 +1,269 @@
+import argparse
+import bisect
+import json
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from helper.corpus_helper import sentence_separator, text_hashes, slice_mask
+
+
+word_pattern = re.compile(r'\w+')
+
+
+class InvertedIndex():
+    """ class to find terms, stems and phrases in the corpus without scanning the texts
+
+    Every article is split into sentences (like PdfNewsReader.extract_migration_sentences) and words (\\w+, lowercase).
+    For every word of the sorted vocabulary the postings (article, sentence, position) are stored,
+    the postings of term t are term_offsets[t]:term_offsets[t+1] of the postings arrays.
+    Positions skip one number between two sentences, so phrases never cross a sentence boundary.
+    Article numbers are the row positions of the dataframe the index was built from.
+
+    Queries (case insensitive)
+        flüchtling          the word
+        Flücht*             words starting with 'flücht' (one contiguous range of the sorted vocabulary)
+        *flücht*            words containing 'flücht' (like the stems of extract_migration_sentences)
+        "die flücht* kamen" phrase, every word may be a pattern
+
+    Files in the directory
+        term_offsets.npy, docs.npy, sentences.npy, positions.npy (postings)
+        sentence_offsets.npy, sentence_spans.npy (character span of every sentence, per article), text_hashes.npy
+        vocab.json (sorted terms), meta.json (newspaper and year per article)
+    """
+
+    arrays = ['term_offsets', 'docs', 'sentences', 'positions', 'sentence_offsets', 'sentence_spans', 'text_hashes']
+
+    def __init__(self, directory:str='inverted_index'):
+        """ loads an index built by InvertedIndex.build
+
+        Parameters
+        ----------
+        directory:str
+            the directory of the index
+        """
+        self.directory = directory
+        for name in InvertedIndex.arrays:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(directory, 'vocab.json'), 'r', encoding='utf-8') as file:
+            self.terms = json.load(file)
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+        self.newspapers = np.array(self.meta['newspapers'], dtype=object)
+        self.years = np.array(self.meta['years'])
+
+    @staticmethod
+    def sentence_spans_of(text:str) -> list:
+        """ returns the (start, end) character spans of the sentences of a text, the pieces of split_sentences(text) """
+        spans = []
+        start = 0
+        for separator in sentence_separator.finditer(text):
+            spans.append((start, separator.start()))
+            start = separator.end()
+        spans.append((start, len(text)))
+        return spans
+
+    @staticmethod
+    def build(df:pd.DataFrame, directory:str='inverted_index', text_column:str='Extracted Text'):
+        """ builds the index of all texts and stores it
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe with the texts and the columns 'Newspaper' and 'Year'
+        directory:str
+            the directory of the index
+        text_column:str
+            the text column of the dataframe
+
+        Returns
+        -------
+        InvertedIndex
+            the loaded index
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        term_ids = {}
+        terms, docs, sentences, positions = [], [], [], []
+        sentence_offsets = [0]
+        sentence_spans = []
+        texts = df[text_column].fillna('').tolist()
+        for doc, text in enumerate(texts):
+            position = 0
+            spans = InvertedIndex.sentence_spans_of(text)
+            for sentence, (start, end) in enumerate(spans):
+                for word in word_pattern.findall(text[start:end].lower()):
+                    terms.append(term_ids.setdefault(word, len(term_ids)))
+                    docs.append(doc)
+                    sentences.append(sentence)
+                    positions.append(position)
+                    position += 1
+                # gap between sentences
+                position += 1
+            sentence_spans.extend(spans)
+            sentence_offsets.append(len(sentence_spans))
+            if doc % 1000 == 0:
+                print(f"Indexed {doc} of {len(texts)}")
+
+        # renumber the terms in sorted order, a prefix is a contiguous range then
+        vocab = sorted(term_ids)
+        rank = np.empty(len(vocab), dtype=np.int64)
+        rank[np.array([term_ids[term] for term in vocab], dtype=np.int64)] = np.arange(len(vocab))
+        terms = rank[np.array(terms, dtype=np.int64)]
+        # stable: postings of a term stay ordered by article and position
+        order = np.argsort(terms, kind='stable')
+        term_offsets = np.concatenate(([0], np.cumsum(np.bincount(terms, minlength=len(vocab)))))
+
+        np.save(os.path.join(directory, 'term_offsets.npy'), term_offsets.astype(np.int64))
+        np.save(os.path.join(directory, 'docs.npy'), np.array(docs, dtype=np.int32)[order])
+        np.save(os.path.join(directory, 'sentences.npy'), np.array(sentences, dtype=np.int32)[order])
+        np.save(os.path.join(directory, 'positions.npy'), np.array(positions, dtype=np.int32)[order])
+        np.save(os.path.join(directory, 'sentence_offsets.npy'), np.array(sentence_offsets, dtype=np.int64))
+        np.save(os.path.join(directory, 'sentence_spans.npy'), np.array(sentence_spans, dtype=np.int64).reshape(-1, 2))
+        np.save(os.path.join(directory, 'text_hashes.npy'), text_hashes(df, text_column))
+        with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf-8') as file:
+            json.dump(vocab, file, ensure_ascii=False)
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump({'newspapers': df['Newspaper'].tolist(), 'years': [int(year) for year in df['Year']], 'text_column': text_column}, file)
+        print(f"Indexed {len(terms)} words ({len(vocab)} terms) of {len(texts)} texts in {directory}")
+        return InvertedIndex(directory)
+
+    @staticmethod
+    def load_or_build(df:pd.DataFrame, directory:str='inverted_index', text_column:str='Extracted Text'):
+        """ loads the index, builds it again if it does not exist or does not match the texts of the dataframe """
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            index = InvertedIndex(directory)
+            if index.matches(df, text_column):
+                return index
+            print(f"Inverted index {directory} does not match the corpus, building again")
+        return InvertedIndex.build(df, directory, text_column)
+
+    def matches(self, df:pd.DataFrame, text_column:str='Extracted Text') -> bool:
+        """ returns True if the index contains exactly the texts of the dataframe (same order) """
+        return len(df) == len(self.text_hashes) and bool(np.array_equal(text_hashes(df, text_column), self.text_hashes))
+
+    def __len__(self):
+        return len(self.sentence_offsets) - 1
+
+    def term_ids(self, pattern:str) -> np.ndarray:
+        """ returns the ids of the terms matching a word pattern (word, prefix* or *substring*) """
+        pattern = pattern.lower()
+        if pattern.startswith('*') and pattern.endswith('*') and len(pattern) > 1:
+            part = pattern.strip('*')
+            return np.array([i for i, term in enumerate(self.terms) if part in term], dtype=np.int64)
+        if pattern.endswith('*'):
+            prefix = pattern[:-1]
+            start = bisect.bisect_left(self.terms, prefix)
+            # every term with the prefix sorts before prefix + the highest character
+            end = bisect.bisect_left(self.terms, prefix + '\U0010ffff')
+            return np.arange(start, end, dtype=np.int64)
+        i = bisect.bisect_left(self.terms, pattern)
+        return np.array([i] if i < len(self.terms) and self.terms[i] == pattern else [], dtype=np.int64)
+
+    def postings(self, pattern:str) -> np.ndarray:
+        """ returns the numbers of the postings of all terms matching a word pattern """
+        ids = self.term_ids(pattern)
+        starts = self.term_offsets[ids]
+        lengths = self.term_offsets[ids + 1] - starts
+        if len(ids) == 0 or lengths.sum() == 0:
+            return np.array([], dtype=np.int64)
+        # start of every term repeated per posting plus the number inside the term
+        shift = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return shift + np.arange(lengths.sum())
+
+    def rows_mask(self, newspaper:str='ALL', years:list|str='ALL') -> np.ndarray:
+        """ returns a mask of the articles of a newspaper and/or years
+
+        Parameters
+        ----------
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+        """
+        return slice_mask(self.newspapers, self.years, newspaper, years)
+
+    def find(self, query:str|list, newspaper:str='ALL', years:list|str='ALL') -> tuple:
+        """ returns the sentences matching the query
+
+        Parameters
+        ----------
+        query:str|list
+            a word pattern or phrase (see class documentation), a list of queries matches any of them
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            article numbers and sentence numbers (inside the article) of the matching sentences, sorted
+        """
+        queries = [query] if isinstance(query, str) else query
+        hits = []
+        for q in queries:
+            words = q.strip().strip('"').split()
+            if not words:
+                continue
+            # key of a posting: article and position
+            found = self.postings(words[0])
+            keys = (self.docs[found].astype(np.int64) << 32) | self.positions[found]
+            sentences = np.asarray(self.sentences[found], dtype=np.int64)
+            for offset, word in enumerate(words[1:], start=1):
+                following = self.postings(word)
+                next_keys = ((self.docs[following].astype(np.int64) << 32) | self.positions[following]) - offset
+                keep = np.isin(keys, next_keys)
+                keys, sentences = keys[keep], sentences[keep]
+            hits.append(np.unique((keys >> 32 << 32) | sentences))
+        hits = np.unique(np.concatenate(hits)) if hits else np.array([], dtype=np.int64)
+        docs, sentences = hits >> 32, hits & 0xffffffff
+        keep = self.rows_mask(newspaper, years)[docs]
+        return docs[keep], sentences[keep]
+
+    def rows(self, query:str|list, newspaper:str='ALL', years:list|str='ALL') -> np.ndarray:
+        """ returns the article numbers (row positions of the dataframe) matching the query, see find """
+        return np.unique(self.find(query, newspaper, years)[0])
+
+    def count(self, query:str|list, newspaper:str='ALL', years:list|str='ALL') -> pd.Series:
+        """ returns the amount of matching sentences per newspaper and year """
+        docs, _ = self.find(query, newspaper, years)
+        return pd.Series(1, index=pd.MultiIndex.from_arrays([self.newspapers[docs], self.years[docs]], names=['Newspaper', 'Year'])).groupby(level=[0, 1]).sum()
+
+    def extract_sentences(self, texts:pd.Series, query:str|list, separator:str=' ') -> pd.Series:
+        """ returns the matching sentences of every article joined by separator ('' if none)
+
+        Parameters
+        ----------
+        texts: pd.Series
+            the texts the index was built from (same order)
+        query:str|list
+            see find
+        """
+        result = [''] * len(texts)
+        docs, sentences = self.find(query)
+        values = texts.fillna('').tolist()
+        boundaries = np.flatnonzero(np.diff(docs)) + 1
+        for doc_sentences in np.split(np.arange(len(docs)), boundaries):
+            if len(doc_sentences) == 0:
+                continue
+            doc = docs[doc_sentences[0]]
+            spans = self.sentence_spans[self.sentence_offsets[doc] + sentences[doc_sentences]]
+            result[doc] = separator.join(values[doc][start:end] for start, end in spans)
+        return pd.Series(result, index=texts.index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Searches the inverted index of the corpus')
+    parser.add_argument('query', nargs='+', help="word, prefix* , *substring* or a phrase in quotes")
+    parser.add_argument('--directory', default='inverted_index')
+    parser.add_argument('--newspaper', default='ALL')
+    parser.add_argument('--years', default='ALL', help='comma separated years')
+    args = parser.parse_args()
+
+    index = InvertedIndex(args.directory)
+    years = args.years if args.years == 'ALL' else [int(year) for year in args.years.split(',')]
+    start = time.perf_counter()
+    docs, sentences = index.find(args.query, args.newspaper, years)
+    print(f"{len(docs)} sentences in {len(np.unique(docs))} articles ({(time.perf_counter() - start) * 1000:.1f} ms)")
@@ -1,6 +1,27 @@
 import nltk
 import spacy
+import numpy as np
+import pandas as pd
+import itertools
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from spacy.attrs import POS, LOWER, LEMMA
+from spacy.symbols import NOUN
+from helper.token_store import TokenStore
+
+
+# nlp and stop word hashes of a worker process (see Noun_Counter.get_most_common_nouns_by_slice)
+_worker_nlp = None
+_worker_stop_hashes = None
+
+def _init_worker(model_name:str, stopwords:set):
+    global _worker_nlp, _worker_stop_hashes
+    _worker_nlp = spacy.load(model_name, disable=["parser", "ner"])
+    _worker_stop_hashes = Noun_Counter.stop_hashes(_worker_nlp, stopwords)
+
+def _count_worker(args:tuple) -> dict:
+    labels, texts, batch_size = args
+    return Noun_Counter.count_nouns(_worker_nlp, _worker_stop_hashes, labels, texts, batch_size)
 
 class Noun_Counter():
     """ class to calculate Sentiment WS
@@ -75,11 +96,161 @@ class Noun_Counter():
             self.nlp=nlp
 
 
-    def get_most_common_nouns(self,texts, top_n=20): 
-        all_nouns = [] 
-        for doc in self.nlp.pipe(texts, disable=["parser", "ner"]): 
-            nouns = [token.lemma_ for token in doc if token.pos_ == "NOUN" and token.text.lower() not in self.stopwords] 
-            all_nouns.extend(nouns) 
-        return Counter(all_nouns).most_common(top_n)
+    @staticmethod
+    def stop_hashes(nlp, stopwords:set) -> np.ndarray:
+        """ returns the hashes of the stopwords in the string store of nlp """
+        return np.array([nlp.vocab.strings.add(word) for word in stopwords], dtype=np.uint64)
+
+    @staticmethod
+    def count_nouns(nlp, stop_hashes:np.ndarray, labels:list, texts:list, batch_size:int) -> dict:
+        """ counts the noun lemmas of the texts per label
+
+        POS, lowercase form and lemma of a document are taken as one array (doc.to_array),
+        nouns and stop words are selected for all tokens at once
+
+        Returns
+        -------
+        dict
+            label -> Counter of lemmas
+        """
+        counters = {}
+        for label, doc in zip(labels, nlp.pipe(texts, disable=["parser", "ner"], batch_size=batch_size)):
+            tokens = doc.to_array([POS, LOWER, LEMMA])
+            nouns = (tokens[:, 0] == NOUN) & ~np.isin(tokens[:, 1], stop_hashes)
+            counters.setdefault(label, Counter()).update(tokens[nouns, 2].tolist())
+        # hashes are the same in every process, the strings are only known to this nlp
+        return {label: Counter({nlp.vocab.strings[h]: n for h, n in counter.items()}) for label, counter in counters.items()}
+
+    def get_most_common_nouns(self,texts, top_n=20, n_process:int=1, batch_size:int=256): 
+        """
+        returns the most common noun lemmas of the texts (stopwords are ignored)
+
+        Parameters
+        ----------
+        texts:
+            the texts (any iterable, e.g. a generator)
+        top_n:int
+            amount of nouns
+        n_process:int
+            amount of worker processes
+        batch_size:int
+            batch size of nlp.pipe
+
+        Returns
+        -------
+        list
+            list of (noun, count)
+        """
+        return self.get_most_common_nouns_by_slice(texts, itertools.repeat(0), top_n, n_process, batch_size).get(0, [])
+
+    def get_most_common_nouns_by_slice(self, texts, labels, top_n=20, n_process:int=1, batch_size:int=256) -> dict:
+        """
+        returns the most common noun lemmas of several slices with one pass over the texts
+
+        Example
+        -------
+            labels = df['Year'].map({2012: '2012/13', 2013: '2012/13', 2023: '2023'})
+            nc.get_most_common_nouns_by_slice(df['Extracted Text'], labels)
+
+        With n_process > 1 the texts are split into chunks, every worker process loads the spaCy model
+        of nlp (without additional components like sentiws) and returns partial counters, which are merged.
+
+        Parameters
+        ----------
+        texts:
+            the texts
+        labels:
+            the slice of every text, texts with label None/NaN are skipped
+        top_n:int
+            amount of nouns per slice
+        n_process:int
+            amount of worker processes
+        batch_size:int
+            batch size of nlp.pipe
+
+        Returns
+        -------
+        dict
+            label -> list of (noun, count)
+        """
+        selected = [(label, text) for label, text in zip(labels, texts) if not pd.isna(label) and not pd.isna(text)]
+        labels = [label for label, _ in selected]
+        texts = [text for _, text in selected]
+
+        totals = {}
+        if n_process <= 1:
+            partials = [Noun_Counter.count_nouns(self.nlp, Noun_Counter.stop_hashes(self.nlp, self.stopwords), labels, texts, batch_size)]
+        else:
+            chunk_size = max(batch_size, -(-len(texts) // (n_process * 4)))
+            chunks = [(labels[i:i + chunk_size], texts[i:i + chunk_size], batch_size) for i in range(0, len(texts), chunk_size)]
+            model_name = f"{self.nlp.meta['lang']}_{self.nlp.meta['name']}"
+            with ProcessPoolExecutor(max_workers=n_process, initializer=_init_worker, initargs=(model_name, self.stopwords)) as executor:
+                # map keeps the order of the chunks, so equal counts keep the order of first occurrence
+                partials = list(executor.map(_count_worker, chunks))
+        for partial in partials:
+            for label, counter in partial.items():
+                totals.setdefault(label, Counter()).update(counter)
+        return {label: counter.most_common(top_n) for label, counter in totals.items()}
+
+    def get_most_common_nouns_from_store(self, token_store:TokenStore, rows=None, top_n=20):
+        """
+        returns the most common noun lemmas like get_most_common_nouns, but counts the tokens of the store
+
+        Parameters
+        ----------
+        token_store: TokenStore
+            the tokens of the corpus
+        rows:
+            the article numbers to count (e.g. token_store.rows('ALL', [2012, 2013])), default: all
+        top_n:int
+            amount of nouns
+
+        Returns
+        -------
+        list
+            list of (noun, count)
+        """
+        positions = token_store.positions(rows)
+        stop_ids = [i for i in (token_store.string_id(word) for word in self.stopwords) if i >= 0]
+        nouns = (token_store.pos[positions] == token_store.pos_id('NOUN')) & ~np.isin(token_store.lower[positions], stop_ids)
+        counts = np.bincount(token_store.lemma[positions][nouns], minlength=len(token_store.strings))
+        top = np.lexsort((np.arange(len(counts)), -counts))[:top_n]
+        return [(token_store.strings[i], int(counts[i])) for i in top if counts[i] > 0]
+
+    def get_most_common_nouns_from_store_by_slice(self, token_store:TokenStore, slices:dict, top_n=20) -> dict:
+        """
+        returns the most common noun lemmas of several slices of the store,
+        counted by one bincount over (slice, lemma) ids
+
+        Parameters
+        ----------
+        token_store: TokenStore
+            the tokens of the corpus
+        slices: dict
+            label -> article numbers, e.g. {'2023': token_store.rows('ALL', [2023])}
+        top_n:int
+            amount of nouns per slice
+
+        Returns
+        -------
+        dict
+            label -> list of (noun, count)
+        """
+        names = list(slices.keys())
+        rows = [np.asarray(slices[name]) for name in names]
+        positions = token_store.positions(np.concatenate(rows))
+        lengths = [int((token_store.offsets[r + 1] - token_store.offsets[r]).sum()) for r in rows]
+        slice_ids = np.repeat(np.arange(len(names)), lengths)
+
+        stop_ids = [i for i in (token_store.string_id(word) for word in self.stopwords) if i >= 0]
+        nouns = (token_store.pos[positions] == token_store.pos_id('NOUN')) & ~np.isin(token_store.lower[positions], stop_ids)
+        vocab_size = len(token_store.strings)
+        counts = np.bincount(slice_ids[nouns] * vocab_size + token_store.lemma[positions][nouns], minlength=len(names) * vocab_size).reshape(len(names), vocab_size)
+
+        result = {}
+        for name, slice_counts in zip(names, counts):
+            top = np.lexsort((np.arange(vocab_size), -slice_counts))[:top_n]
+            result[name] = [(token_store.strings[i], int(slice_counts[i])) for i in top if slice_counts[i] > 0]
+        return result
     
     
\ No newline at end of file
@@ -1,9 +1,15 @@
 
 import datetime
+import os
 import pandas as pd
 import re
 import PyPDF2
 import locale
+from helper.instrumentation import Tracer
+from helper.inverted_index import InvertedIndex
+from helper.corpus_helper import split_sentences
+
+tracer = Tracer.getInstance()
 
 class PdfNewsReader():
     """ class to calculate Sentiment WS
@@ -70,9 +76,10 @@ class PdfNewsReader():
             # each document will be appended to this one
             df_text = pd.DataFrame({'Extracted Text':[],'Publication Date':[],'Load Date':[],'Words':[]})
             
-            for page in reader.pages:
+            for page_number, page in enumerate(reader.pages):
                 
-                page_text = page.extract_text()
+                with tracer.span('pdf.page', path=pdf_path, page=page_number):
+                    page_text = page.extract_text()
                 if page_text:
                     #search for the start of the document
                     match = re.search(f'{re.escape(start_marker)}',page_text)
@@ -138,10 +145,14 @@ class PdfNewsReader():
                     
             return df_text
         
-        with open(pdf_path, 'rb') as file:
+        with tracer.span('pdf', path=pdf_path) as span, open(pdf_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
             #extracted_texts = extract_all_text_between_markers('Body', 'End of Document', reader)
             dfs = extract_all_text_between_markers('Body', 'End of Document', reader)
+            span['pages'] = len(reader.pages)
+            span['articles'] = len(dfs)
+            tracer.count('pdf.pages', len(reader.pages))
+            tracer.count('pdf.articles', len(dfs))
 
         # show info if necessary
         #print( dfs.info())
@@ -149,7 +160,19 @@ class PdfNewsReader():
         return dfs
     
     @staticmethod
-    def process_all_newspaper_articles(directory_name:str="NewsArtikel",newspaper_names = ['ZEIT', 'SPO', 'TAZ', 'WELT'],parts = [1,2,3,4,5]):
+    def pdf_path(directory_name:str, prefix, newspaper_name:str, suffix) -> str:
+        """ returns the path of the file <prefix>_<newspaper_name>_<suffix> with extension .PDF or .pdf
+
+        If neither exists, the path with .PDF is returned (and reading it fails with FileNotFoundError).
+        """
+        base = os.path.join(directory_name, f'{prefix}_{newspaper_name}_{suffix}')
+        for extension in ['.PDF', '.pdf']:
+            if os.path.exists(base + extension):
+                return base + extension
+        return base + '.PDF'
+
+    @staticmethod
+    def process_all_newspaper_articles(directory_name:str="NewsArtikel",newspaper_names = ['ZEIT', 'SPO', 'TAZ', 'WELT'],parts = [1,2,3,4,5],index_directory:str=None):
         """
         Processes all PDF files for the newspapers with a naming convention using prefixes (years 2012,2015,2023)
         and suffixes from 1 to 5.
@@ -158,6 +181,8 @@ class PdfNewsReader():
         ----------
         directory_name: str
             Directory name of the files' location.
+        index_directory: str
+            if given, the inverted index of the texts is built and stored in this directory (see InvertedIndex)
 
         Returns
         ----------
@@ -167,6 +192,7 @@ class PdfNewsReader():
         locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
 
         dataframes = []
+        progress = tracer.progress('pdf files', 3 * len(newspaper_names) * len(parts))
 
         # Loop through the prefixes, newspaper names, and suffixes
         for prefix in [2012,2015,2023]:
@@ -174,13 +200,14 @@ class PdfNewsReader():
             for newspaper_name in newspaper_names:
                 for suffix in parts:
                     #suffix = 1
-                    pdf_path = f'{directory_name}/{prefix}_{newspaper_name}_{suffix}.PDF'
+                    pdf_path = PdfNewsReader.pdf_path(directory_name, prefix, newspaper_name, suffix)
                     print(f"Reading next file: {pdf_path}")
                     df = PdfNewsReader.extract_texts_to_df(pdf_path)  # Assuming you have a function named extract_texts_to_df
                     df['Newspaper'] = newspaper_name
                     df['Part'] = f'{prefix}_{newspaper_name}_{suffix}'
 
                     dataframes.append(df)
+                    progress.update()
 
         # Concatenate all DataFrames into a single DataFrame
         final_df = pd.concat(dataframes, ignore_index=True)
@@ -190,6 +217,10 @@ class PdfNewsReader():
         final_df['Year'] = final_df['Publication Date'].dt.year
         final_df['Words'] = final_df['Words'].astype('int64')
 
+        if index_directory is not None:
+            with tracer.span('inverted_index', articles=len(final_df)):
+                InvertedIndex.build(final_df, index_directory)
+
         return final_df
 
 
@@ -268,8 +299,28 @@ class PdfNewsReader():
         sentences which contain at least one of the word of text 
         '''
         # Split text into sentences
-        sentences = re.split(r'(?<=[.!?])\s+', text)
+        sentences = split_sentences(text)
         # Filter sentences that contain any of the migration stems
         migration_sentences = [sentence for sentence in sentences if any(stem.lower() in sentence.lower() for stem in PdfNewsReader.migration_stems)]
         # Combine filtered sentences back into a single text
-        return ' '.join(migration_sentences)
\ No newline at end of file
+        return ' '.join(migration_sentences)
+
+    @staticmethod
+    def extract_migration_sentences_indexed(df:pd.DataFrame, index:InvertedIndex, text_column:str='Extracted Text') -> pd.Series:
+        ''' extract_migration_sentences for all texts of the dataframe, reading the matching sentences from the inverted index
+
+        Same result as df[text_column].apply(PdfNewsReader.extract_migration_sentences) without scanning every text,
+        the stems are looked up in the vocabulary of the index (*stem* queries).
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe the index was built from
+        index: InvertedIndex
+            the index of the texts
+        Returns:
+        pd.Series with the migration sentences of every text ('' if none)
+        '''
+        if not index.matches(df, text_column):
+            raise ValueError('The inverted index does not contain the texts of the dataframe')
+        return index.extract_sentences(df[text_column], [f'*{stem}*' for stem in PdfNewsReader.migration_stems])
\ No newline at end of file
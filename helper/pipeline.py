@@ -0,0 +1,333 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+def file_hash(path:str) -> str:
+    """ returns the sha1 of the content of a file """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Stage():
+    """ one step of the pipeline
+
+    function(inputs, params, work_dir) gets the outputs of the dependencies (name -> output),
+    the parameters of the stage and a directory for files of this stage version, it returns the output
+    (anything that can be pickled).
+    """
+
+    def __init__(self, name:str, function, dependencies:list=(), params:dict=None, input_files=None, version:int=1, process:bool=False):
+        """
+        Parameters
+        ----------
+        name:str
+            unique name of the stage
+        function:
+            the function calculating the output
+        dependencies:list
+            names of the stages whose outputs are needed
+        params:dict
+            parameters of the stage (part of the cache key, must be json serializable)
+        input_files:
+            function returning the list of files read by the stage (their content is part of the cache key)
+        version:int
+            increase to invalidate cached outputs after changing the function
+        process:bool
+            run the function in a worker process (CPU-bound python code holding the GIL),
+            function must be defined at module level, inputs and output are pickled
+        """
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.params = params or {}
+        self.input_files = input_files
+        self.version = version
+        self.process = process
+
+
+class Pipeline():
+    """ runs stages in order of their dependencies and caches every output
+
+    The cache key of a stage is built from its name, version, parameters, the content of its input files
+    and the content hashes of the outputs of its dependencies. A stage runs only if no output for its key
+    is cached, so a change only recomputes the stages depending on changed data
+    (an unchanged output also stops the recomputation of the following stages).
+    Stages whose dependencies are finished run concurrently in threads. Only native code releasing the GIL
+    (BERT/torch, gensim) overlaps in threads, so stages running python code (spaCy components, tokenizing)
+    are marked with process=True and run in worker processes.
+    """
+
+    def __init__(self, cache_dir:str='pipeline_cache', max_workers:int=3):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.stages = {}
+        self._outputs = {}
+        self._lock = threading.Lock()
+        self._processes = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add(self, stage:Stage):
+        for dependency in stage.dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {stage.name}: unknown dependency {dependency} (add dependencies first)')
+        self.stages[stage.name] = stage
+
+    def required(self, targets:list) -> list:
+        """ returns the targets and all their dependencies in order of the dependencies """
+        ordered = []
+        def visit(name:str):
+            if name not in ordered:
+                for dependency in self.stages[name].dependencies:
+                    visit(dependency)
+                ordered.append(name)
+        for target in targets:
+            visit(target)
+        return ordered
+
+    def _key(self, stage:Stage, output_hashes:dict) -> str:
+        key = {'name': stage.name, 'version': stage.version, 'params': stage.params,
+               'dependencies': {name: output_hashes[name] for name in stage.dependencies}}
+        if stage.input_files is not None:
+            key['files'] = {path: file_hash(path) for path in stage.input_files()}
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+    def _path(self, name:str, key:str) -> str:
+        return os.path.join(self.cache_dir, f'{name}-{key}')
+
+    def output(self, name:str, key:str):
+        """ returns the output of a stage, loaded from the cache on first access """
+        with self._lock:
+            if (name, key) not in self._outputs:
+                with open(self._path(name, key) + '.pkl', 'rb') as file:
+                    self._outputs[(name, key)] = pickle.load(file)
+            return self._outputs[(name, key)]
+
+    def _run_stage(self, stage:Stage, key:str, keys:dict) -> str:
+        inputs = {name: self.output(name, keys[name]) for name in stage.dependencies}
+        work_dir = self._path(stage.name, key) + '.files'
+        os.makedirs(work_dir, exist_ok=True)
+        print(f'Running stage {stage.name}')
+        start = time.time()
+        if stage.process:
+            output = self._process_pool().submit(stage.function, inputs, stage.params, work_dir).result()
+        else:
+            output = stage.function(inputs, stage.params, work_dir)
+        data = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+        output_hash = hashlib.sha1(data).hexdigest()
+        # write the output before the hash file, the hash file marks a complete entry
+        with open(self._path(stage.name, key) + '.pkl', 'wb') as file:
+            file.write(data)
+        with open(self._path(stage.name, key) + '.json', 'w') as file:
+            json.dump({'output_hash': output_hash, 'seconds': time.time() - start}, file)
+        with self._lock:
+            self._outputs[(stage.name, key)] = output
+        print(f'Finished stage {stage.name} in {time.time() - start:.1f}s')
+        return output_hash
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                # spawn: forking a process with running torch threads can deadlock
+                self._processes = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._processes
+
+    def run(self, targets:list=None, force:list=()) -> dict:
+        """ runs the stages needed for the targets
+
+        Parameters
+        ----------
+        targets:list
+            names of the stages to produce, default: all stages
+        force:list
+            names of stages to run even if their output is cached
+
+        Returns
+        -------
+        dict
+            stage name -> cache key of its output (see output)
+        """
+        names = self.required(targets if targets else list(self.stages))
+        keys = {}
+        output_hashes = {}
+        pending = set(names)
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while pending or running:
+                    # start every stage whose dependencies are finished
+                    for name in [n for n in names if n in pending]:
+                        stage = self.stages[name]
+                        if not all(d in output_hashes for d in stage.dependencies):
+                            continue
+                        pending.discard(name)
+                        key = self._key(stage, output_hashes)
+                        keys[name] = key
+                        hash_file = self._path(name, key) + '.json'
+                        if name not in force and os.path.exists(hash_file):
+                            with open(hash_file, 'r') as file:
+                                output_hashes[name] = json.load(file)['output_hash']
+                            print(f'Stage {name} is up to date')
+                            continue
+                        running[executor.submit(self._run_stage, stage, key, dict(keys))] = name
+                    if not running:
+                        # all startable stages were cached, look again for stages depending on them
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        output_hashes[name] = future.result()
+        finally:
+            if self._processes is not None:
+                self._processes.shutdown()
+                self._processes = None
+        return keys
+
+
+# stages of the analysis (BuildDataFrame.ipynb)
+
+def _pdf_files(params:dict) -> list:
+    from helper.pdf_news_reader import PdfNewsReader
+    return [PdfNewsReader.pdf_path(params['directory'], prefix, newspaper, suffix)
+            for prefix in [2012, 2015, 2023] for newspaper in params['newspapers'] for suffix in params['parts']]
+
+def _ingest(inputs, params, work_dir):
+    from helper.pdf_news_reader import PdfNewsReader
+    return PdfNewsReader.process_all_newspaper_articles(params['directory'], params['newspapers'], params['parts'])
+
+def _inverted_index(inputs, params, work_dir):
+    from helper.inverted_index import InvertedIndex
+    InvertedIndex.build(inputs['ingest'], os.path.join(work_dir, 'inverted_index'))
+    return os.path.join(work_dir, 'inverted_index')
+
+def _migtext(inputs, params, work_dir):
+    from helper.pdf_news_reader import PdfNewsReader
+    from helper.inverted_index import InvertedIndex
+    return PdfNewsReader.extract_migration_sentences_indexed(inputs['ingest'], InvertedIndex(inputs['inverted_index']))
+
+def _bert(inputs, params, work_dir):
+    from helper.sentiment_bert import SentimentBert
+    df = inputs['ingest'][['Extracted Text']].copy()
+    if 'migtext' in inputs:
+        df['Extracted Text'] = inputs['migtext']
+    token_cache = SentimentBert.get_token_cache(params['token_cache'])
+    SentimentBert.calculate_sentiment_probabilities(df, text_column='Extracted Text', prefix=params['prefix'], token_cache=token_cache)
+    df[params['score_column']] = SentimentBert.probabilities_to_score(df, prefix=params['prefix'])
+    return df.drop(columns=['Extracted Text'])
+
+def _sentiws(inputs, params, work_dir):
+    import pandas as pd
+    from helper.sentiws_metric import SentiWS_Metric
+    analyze = SentiWS_Metric.getInstance().analyze_sentiment_ws_text
+    df = pd.DataFrame([analyze(text) for text in inputs['ingest']['Extracted Text']],
+                      columns=['pos_count', 'neg_count', 'pos_value', 'neg_value'], index=inputs['ingest'].index)
+    df['polarity'] = df['pos_count'] - df['neg_count']
+    df['clearly-Polarity'] = df['pos_value'] + df['neg_value']
+    return df
+
+def _token_store(inputs, params, work_dir):
+    from helper.token_store import TokenStore
+    TokenStore.build(inputs['ingest'], os.path.join(work_dir, 'token_store'))
+    return os.path.join(work_dir, 'token_store')
+
+def _corpus(inputs, params, work_dir):
+    import pandas as pd
+    df = inputs['ingest'].copy()
+    df['MigText'] = inputs['migtext']
+    df = pd.concat([df, inputs['bert'], inputs['bert_migtext'], inputs['sentiws']], axis=1)
+    df.to_csv(params['csv_file'], index=False)
+    return df
+
+def _tfidf(inputs, params, work_dir):
+    from helper.tfidf_helper import CorpusTfidf
+    from helper.token_store import TokenStore
+    return CorpusTfidf(inputs['corpus'], token_store=TokenStore(inputs['token_store'])).top_terms_batch(top_n=params['top_n'])
+
+def _word2vec(inputs, params, work_dir):
+    from helper.word2vec_helper import find_similar_words
+    from helper.token_store import TokenStore
+    df = inputs['corpus']
+    store = TokenStore(inputs['token_store'])
+    slices = [('ALL', 'ALL')] + [(newspaper, 'ALL') for newspaper in sorted(df['Newspaper'].unique())] + [('ALL', [int(year)]) for year in sorted(df['Year'].unique())]
+    result = {}
+    for newspaper, years in slices:
+        try:
+            result[(newspaper, str(years))] = find_similar_words(df, newspaper, years, params['words'], token_store=store, cache_dir=os.path.join(work_dir, 'models'))
+        except KeyError as e:
+            # search word not in the vocabulary of the slice
+            result[(newspaper, str(years))] = str(e)
+    return result
+
+def _nouns(inputs, params, work_dir):
+    from helper.noun_counter import Noun_Counter
+    from helper.token_store import TokenStore
+    import nltk
+    store = TokenStore(inputs['token_store'])
+    nc = Noun_Counter.getInstance()
+    nc.set_stopwords(set(nltk.corpus.stopwords.words('german')))
+    nc.add_custom_words({"load-date", "page"})
+    slices = {name: store.rows('ALL', years) for name, years in params['periods'].items()}
+    return nc.get_most_common_nouns_from_store_by_slice(store, slices, params['top_n'])
+
+def build_pipeline(directory:str='NewsArtikel', newspapers:list=['ZEIT', 'SPO', 'TAZ', 'WELT'], parts:list=[1,2,3,4,5],
+                   cache_dir:str='pipeline_cache', csv_file:str='korpus_calculated.csv', words:list=['flüchtling', 'migration'], max_workers:int=3) -> Pipeline:
+    """ returns the pipeline of BuildDataFrame.ipynb
+
+    ingest -> bert, sentiws, token_store, inverted_index (concurrently, the last three in worker processes)
+    inverted_index -> migtext
+    bert, migtext -> bert_migtext
+    corpus (csv file) -> tfidf, word2vec, nouns
+    """
+    pipeline = Pipeline(cache_dir, max_workers)
+    ingest_params = {'directory': directory, 'newspapers': list(newspapers), 'parts': list(parts)}
+    token_cache = os.path.join(cache_dir, 'token_cache')
+    pipeline.add(Stage('ingest', _ingest, params=ingest_params, input_files=lambda: _pdf_files(ingest_params)))
+    pipeline.add(Stage('inverted_index', _inverted_index, ['ingest'], process=True))
+    pipeline.add(Stage('migtext', _migtext, ['ingest', 'inverted_index']))
+    pipeline.add(Stage('bert', _bert, ['ingest'], {'prefix': 'Sentiment', 'score_column': 'Sentiment_Score', 'token_cache': token_cache}))
+    # after bert: both write into the same token cache
+    pipeline.add(Stage('bert_migtext', _bert, ['ingest', 'migtext', 'bert'], {'prefix': 'Sentiment_MigText', 'score_column': 'SentiScore_Migtext', 'token_cache': token_cache}))
+    pipeline.add(Stage('sentiws', _sentiws, ['ingest'], process=True))
+    pipeline.add(Stage('token_store', _token_store, ['ingest'], process=True))
+    pipeline.add(Stage('corpus', _corpus, ['ingest', 'migtext', 'bert', 'bert_migtext', 'sentiws'], {'csv_file': csv_file}))
+    pipeline.add(Stage('tfidf', _tfidf, ['corpus', 'token_store'], {'top_n': 20}))
+    pipeline.add(Stage('word2vec', _word2vec, ['corpus', 'token_store'], {'words': list(words)}))
+    pipeline.add(Stage('nouns', _nouns, ['corpus', 'token_store'], {'top_n': 20, 'periods': {'2012/13': [2012, 2013], '2015/16': [2015, 2016], '2023': [2023]}}))
+    return pipeline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs the analysis stages, only stages with changed inputs are calculated again')
+    parser.add_argument('--directory', default='NewsArtikel', help='directory of the pdf files')
+    parser.add_argument('--newspapers', default='ZEIT,SPO,TAZ,WELT')
+    parser.add_argument('--parts', default='1,2,3,4,5')
+    parser.add_argument('--cache-dir', default='pipeline_cache')
+    parser.add_argument('--csv-file', default='korpus_calculated.csv')
+    parser.add_argument('--words', default='flüchtling,migration', help='search words for Word2Vec')
+    parser.add_argument('--workers', type=int, default=3, help='amount of stages running at the same time')
+    parser.add_argument('--targets', default='', help='comma separated stages to produce (default: all)')
+    parser.add_argument('--force', default='', help='comma separated stages to run even if cached')
+    parser.add_argument('--list', action='store_true', help='list the stages and exit')
+    args = parser.parse_args()
+
+    pipeline = build_pipeline(args.directory, args.newspapers.split(','), [int(part) for part in args.parts.split(',')],
+                              args.cache_dir, args.csv_file, args.words.split(','), args.workers)
+    if args.list:
+        for stage in pipeline.stages.values():
+            print(f"{stage.name:<14} <- {', '.join(stage.dependencies)}")
+    else:
+        targets = [t for t in args.targets.split(',') if t]
+        keys = pipeline.run(targets, [f for f in args.force.split(',') if f])
+        for name in ['tfidf', 'word2vec', 'nouns']:
+            if name in keys:
+                print(f'--- {name}')
+                print(pipeline.output(name, keys[name]))
@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import collections
+import json
+import math
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+class ServiceMetrics():
+    """ collects queue depth, batch sizes and latencies of the scoring service
+
+    Latencies are kept for the last window_size requests per operation
+    """
+
+    def __init__(self, window_size:int=10000):
+        self.started = time.time()
+        self.requests = collections.Counter()
+        self.batches = collections.Counter()
+        self.batch_sizes = collections.defaultdict(collections.Counter)
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window_size))
+
+    def add_batch(self, op:str, size:int, latencies:list):
+        self.requests[op] += size
+        self.batches[op] += 1
+        self.batch_sizes[op][size] += 1
+        self.latencies[op].extend(latencies)
+
+    @staticmethod
+    def percentile(values:list, p:float) -> float:
+        """ returns the p-th percentile (0-100) of the values, nearest rank """
+        if not values:
+            return float('nan')
+        ordered = sorted(values)
+        rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def to_dict(self, queues:dict) -> dict:
+        result = {'uptime_in_sec': time.time() - self.started, 'operations': {}}
+        for op, queue in queues.items():
+            latencies = list(self.latencies[op])
+            batches = self.batches[op]
+            result['operations'][op] = {
+                'queue_depth': queue.qsize(),
+                'requests': self.requests[op],
+                'batches': batches,
+                'mean_batch_size': self.requests[op] / batches if batches else 0,
+                'batch_sizes': dict(sorted(self.batch_sizes[op].items())),
+                'latency_p50_ms': ServiceMetrics.percentile(latencies, 50) * 1000,
+                'latency_p99_ms': ServiceMetrics.percentile(latencies, 99) * 1000,
+            }
+        return result
+
+
+class ScoringService():
+    """ asyncio server that keeps one BERT model and one SentiWS pipeline loaded
+
+    Clients send texts (one or many) to the server, all texts waiting in the queue of an operation
+    are collected into a micro batch: a batch is started as soon as max_batch_size texts are waiting
+    or the first text waited max_latency_ms. The models run in a separate thread per operation,
+    so the event loop keeps accepting requests during inference.
+
+    Protocol: one json object per line
+        request:  {"id": 1, "op": "bert"|"sentiws"|"metrics", "texts": ["..."]}
+        response: {"id": 1, "results": [...]} or {"id": 1, "error": "..."}
+    """
+
+    def __init__(self, max_batch_size:int=16, max_latency_ms:float=20):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.metrics = ServiceMetrics()
+        self.scorers = {'bert': ScoringService.score_bert, 'sentiws': ScoringService.score_sentiws}
+        self.queues = {}
+        self.executors = {}
+
+    @staticmethod
+    def score_bert(texts:list) -> list:
+        # imported here, loading the module loads the model
+        from helper.sentiment_bert import SentimentBert
+        results = SentimentBert.sentiment_pipeline(texts, batch_size=len(texts))
+        return [{'label': r['label'], 'score': r['score'], 'Sentiment_Score': SentimentBert.sentiment_to_score([r])} for r in results]
+
+    @staticmethod
+    def score_sentiws(texts:list) -> list:
+        from helper.sentiws_metric import SentiWS_Metric
+        sentiws = SentiWS_Metric.getInstance()
+        results = []
+        for doc in sentiws.nlp.pipe(texts):
+            pos_count, neg_count, pos_value, neg_value = sentiws.analyze_sentiment_ws_tokens(doc)
+            results.append({'pos_count': pos_count, 'neg_count': neg_count, 'pos_value': pos_value, 'neg_value': neg_value,
+                            'polarity': pos_count - neg_count, 'clearly-Polarity': pos_value + neg_value})
+        return results
+
+    def warm_up(self):
+        """ loads the models and runs them once """
+        for scorer in self.scorers.values():
+            scorer(['Die Boote kommen weiterhin.'])
+
+    async def score(self, op:str, texts:list) -> list:
+        """ queues the texts and waits for their results """
+        if op not in self.queues:
+            raise ValueError(f'Unknown operation: {op}')
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            await self.queues[op].put((text, future, time.perf_counter()))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    async def _batcher(self, op:str):
+        queue = self.queues[op]
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executors[op], self.scorers[op], texts)
+            except Exception as e:
+                if len(batch) == 1:
+                    results = [e]
+                else:
+                    # the batch may contain texts of several clients: score one by one, so only the bad text fails
+                    results = []
+                    for text in texts:
+                        try:
+                            results.extend(await loop.run_in_executor(self.executors[op], self.scorers[op], [text]))
+                        except Exception as text_error:
+                            results.append(text_error)
+
+            finished = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.metrics.add_batch(op, len(batch), [finished - queued for _, _, queued in batch])
+
+    async def _handle_request(self, line:bytes, writer:asyncio.StreamWriter, lock:asyncio.Lock):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if request.get('op') == 'metrics':
+                response = {'id': request_id, 'results': self.metrics.to_dict(self.queues)}
+            else:
+                texts = request['texts']
+                if isinstance(texts, str):
+                    texts = [texts]
+                # checked before queueing, a bad request must not fail the batch of other requests
+                if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                    raise TypeError('texts must be a string or a list of strings (no NaN or None)')
+                response = {'id': request_id, 'results': await self.score(request.get('op', 'bert'), texts)}
+        except Exception as e:
+            response = {'id': request_id, 'error': f'{type(e).__name__}: {e}'}
+
+        async with lock:
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            await writer.drain()
+
+    async def _handle_client(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        # requests of one connection are handled concurrently, the responses carry the request id
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self._handle_request(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve(self, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT):
+        """ starts the batchers and serves until cancelled """
+        for op in self.scorers:
+            self.queues[op] = asyncio.Queue()
+            self.executors[op] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'score-{op}')
+        batchers = [asyncio.create_task(self._batcher(op)) for op in self.scorers]
+        server = await asyncio.start_server(self._handle_client, host, port, limit=2**26)
+        print(f'Scoring service listening on {host}:{port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for batcher in batchers:
+                batcher.cancel()
+            for executor in self.executors.values():
+                executor.shutdown(wait=False)
+
+
+class ScoringClient():
+    """ blocking client of the scoring service, usable in notebooks (no event loop needed)
+
+    Example
+    -------
+        client = ScoringClient()
+        client.score_bert(df['Extracted Text'].tolist())
+    """
+
+    def __init__(self, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, timeout:float=None):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.socket.makefile('rwb')
+        self.next_id = 0
+
+    def request(self, op:str, texts:list=None):
+        self.next_id += 1
+        self.file.write(json.dumps({'id': self.next_id, 'op': op, 'texts': texts}).encode('utf-8') + b'\n')
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['results']
+
+    def score_bert(self, texts:list|str) -> list:
+        return self.request('bert', [texts] if isinstance(texts, str) else list(texts))
+
+    def score_sentiws(self, texts:list|str) -> list:
+        return self.request('sentiws', [texts] if isinstance(texts, str) else list(texts))
+
+    def metrics(self) -> dict:
+        return self.request('metrics')
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class AsyncScoringClient():
+    """ asyncio client of the scoring service, several requests may run concurrently on one connection """
+
+    def __init__(self, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.next_id = 0
+        self.pending = {}
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.closed = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=2**26)
+        self.receiver = asyncio.create_task(self._receive())
+        return self
+
+    async def _receive(self):
+        try:
+            while line := await self.reader.readline():
+                response = json.loads(line)
+                future = self.pending.pop(response.get('id'), None)
+                if future is None:
+                    continue
+                if 'error' in response:
+                    future.set_exception(RuntimeError(response['error']))
+                else:
+                    future.set_result(response['results'])
+            self.closed = ConnectionError('Connection closed by the scoring service')
+        except asyncio.CancelledError:
+            self.closed = ConnectionError('Client closed')
+            raise
+        except Exception as e:
+            self.closed = ConnectionError(f'Connection to the scoring service failed: {e}')
+        finally:
+            if self.closed is None:
+                self.closed = ConnectionError('Receiver of the scoring client stopped')
+            # nobody answers the pending requests any more
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(self.closed)
+            self.pending.clear()
+
+    async def request(self, op:str, texts:list=None):
+        if self.receiver is None:
+            raise ConnectionError('Not connected, call connect() first')
+        if self.closed is not None:
+            raise ConnectionError(str(self.closed))
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        self.writer.write(json.dumps({'id': self.next_id, 'op': op, 'texts': texts}).encode('utf-8') + b'\n')
+        await self.writer.drain()
+        return await future
+
+    async def score_bert(self, texts:list|str) -> list:
+        return await self.request('bert', [texts] if isinstance(texts, str) else list(texts))
+
+    async def score_sentiws(self, texts:list|str) -> list:
+        return await self.request('sentiws', [texts] if isinstance(texts, str) else list(texts))
+
+    async def metrics(self) -> dict:
+        return await self.request('metrics')
+
+    async def close(self):
+        self.receiver.cancel()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local scoring service for SentimentBert and SentiWS')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-latency-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    service = ScoringService(max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms)
+    print('Loading models')
+    service.warm_up()
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print('Stopped')
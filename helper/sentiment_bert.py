@@ -3,8 +3,53 @@ import pandas as pd
 import time
 import os
 import platform
+import multiprocessing
+import torch
+import numpy as np
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, pipeline
 import json
+from helper.token_cache import TokenCache
+from helper.instrumentation import Tracer
+
+
+def _sentiment_worker(shard:list, texts:list, labels, scores, progress, threads:int, batch_size:int, use_token_ids:bool=False):
+    """ scores one shard of the corpus inside a worker process
+
+    The worker imports this module on its own (spawn), so it owns a separate copy of the model.
+    Results are written into the shared arrays at the position of the text in the dataframe.
+
+    Parameters
+    ----------
+    shard: list
+        positions of the texts in the dataframe
+    texts: list
+        the texts belonging to the positions (token ids if use_token_ids is set)
+    labels:
+        shared array for the label index (see SentimentBert.labels)
+    scores:
+        shared array for the score of the label
+    progress:
+        shared counter of finished texts
+    threads: int
+        amount of torch threads of this worker
+    batch_size: int
+        amount of texts given to the pipeline at once
+    use_token_ids: bool
+        texts are already tokenized (see TokenCache)
+    """
+    torch.set_num_threads(threads)
+    for start in range(0, len(shard), batch_size):
+        batch_positions = shard[start:start + batch_size]
+        if use_token_ids:
+            results = SentimentBert.score_token_ids(texts[start:start + batch_size], batch_size=batch_size)
+        else:
+            results = SentimentBert.sentiment_pipeline(texts[start:start + batch_size], batch_size=batch_size)
+        for position, result in zip(batch_positions, results):
+            labels[position] = SentimentBert.labels.index(result['label'])
+            scores[position] = result['score']
+        with progress.get_lock():
+            progress.value += len(batch_positions)
+
 
 class SentimentBert():
     """ class to calculate Sentiment via Bert
@@ -34,9 +79,10 @@ class SentimentBert():
     model = AutoModelForSequenceClassification.from_pretrained(model_name)
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     sentiment_pipeline = pipeline("sentiment-analysis", model=model, tokenizer=tokenizer,truncation = True)
+    labels = ('positive', 'negative', 'neutral')
 
     @staticmethod
-    def calculate_sentiment( df:pd.DataFrame, text_column:str, result_column:str, index_file_name ,tmp_file_name='df_korpus_tmp.csv',modulus:int=100, sleeptime_in_sec:int=20, save_df:bool=True):
+    def calculate_sentiment( df:pd.DataFrame, text_column:str, result_column:str, index_file_name ,tmp_file_name='df_korpus_tmp.csv',modulus:int=100, sleeptime_in_sec:int=20, save_df:bool=True, token_cache:TokenCache=None):
         """ calculates the sentiment Bert into a new column of the data frame
 
         After some amount of records the function will sleep for a while to prevent os crashes - happened on a MacBook
@@ -63,9 +109,14 @@ class SentimentBert():
             time in seconds 
         save_df: bool
             if temporary results should be store
+        token_cache: TokenCache
+            if given, all texts are tokenized at once (or read from the cache) before calculating
             
         """
         try:
+            if token_cache is not None:
+                print(f"Tokenized {token_cache.add(df[text_column].dropna().tolist())} new sentences.")
+
             # Read the last index if the file exists
             if os.path.exists(index_file_name):
                 with open(index_file_name, "r") as file:
@@ -74,11 +125,13 @@ class SentimentBert():
                 start_index = 0
         
             print(f"Starting at index {start_index}.")
+            progress = Tracer.getInstance().progress('bert texts', len(df) - start_index)
             
             for i in range(start_index, len(df)):
                 #print(f"running: {i} of {len(df)}")
                 if not pd.isnull(df.at[i, text_column]):
-                    df.at[i, result_column] = SentimentBert.sentiment_pipeline(df.at[i, text_column])
+                    with Tracer.getInstance().span('bert.text', index=i):
+                        df.at[i, result_column] = SentimentBert.score_text(df.at[i, text_column], token_cache)
                     if i> start_index and i % modulus == (start_index % modulus):
                         if save_df:
                             df.to_csv('df_korpus_tmp.csv', index=False)
@@ -88,6 +141,7 @@ class SentimentBert():
                         print(f"Sleep {sleeptime_in_sec} seconds at index {i}")
                         time.sleep(sleeptime_in_sec)
                         print(f"Continuing")
+                progress.update()
                 
             df.to_csv(tmp_file_name, index=False)
             print("Finished, clean up")  
@@ -104,7 +158,7 @@ class SentimentBert():
             df.to_csv(tmp_file_name, index=False)
             print(f"Interrupted by user. Progress saved up to index {i}.")
 
-    def calculate_sentiment_nobreak( df:pd.DataFrame, text_column:str, result_column:str,tmp_file_name:str):
+    def calculate_sentiment_nobreak( df:pd.DataFrame, text_column:str, result_column:str,tmp_file_name:str, token_cache:TokenCache=None):
         """
         calculates the sentiment Bert into a new column of the data frame
 
@@ -122,20 +176,28 @@ class SentimentBert():
             the column where the result will be stored
         tmp_file_name:str
             Resulting dataframe will be stored in this file
+        token_cache: TokenCache
+            if given, all texts are tokenized at once (or read from the cache) before calculating
             
         """
         try:
+            if token_cache is not None:
+                print(f"Tokenized {token_cache.add(df[text_column].dropna().tolist())} new sentences.")
+
             # Read the last index if the file exists
             
             start_index = df.index.min()
             end_index = df.index.max()
             print(f"Starting at index {start_index}.")
+            progress = Tracer.getInstance().progress('bert texts', end_index + 1 - start_index)
             
             for i in range(start_index,end_index+1):
                 if i%100 == 0:
                     print(f"running: {i} of {start_index} {end_index + 1}")
                 if not pd.isnull(df.at[i, text_column]):
-                    df.at[i, result_column] = SentimentBert.sentiment_pipeline(df.at[i, text_column])
+                    with Tracer.getInstance().span('bert.text', index=i):
+                        df.at[i, result_column] = SentimentBert.score_text(df.at[i, text_column], token_cache)
+                progress.update()
                     
             print("storing file")  
 
@@ -151,6 +213,286 @@ class SentimentBert():
             #df.to_csv(tmp_file_name, index=False)
             print(f"Interrupted by user. Progress saved up to index {i}.")
             
+    @staticmethod
+    def calculate_sentiment_parallel( df:pd.DataFrame, text_column:str, result_column:str, tmp_file_name:str=None, processes:int=None, threads_per_process:int=None, batch_size:int=16, report_every_in_sec:int=10, token_cache:TokenCache=None):
+        """
+        calculates the sentiment Bert into a new column of the data frame using several processes
+
+        Alternative to calculate_sentiment_nobreak for machines with many cores. Torch threading alone
+        does not scale to that amount of cores, so the corpus is split into shards and every worker process
+        loads its own model with a limited amount of threads.
+        The texts are sorted by length and dealt round robin, so the shards have about the same amount of work
+        and the batches inside a worker contain texts of similar length (less padding).
+        The workers write label and score into shared memory arrays, the result column is built once at the end
+        in the same format as the pipeline returns for a single text: [{'label': 'neutral', 'score': 0.53}]
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe to work with
+        text_column:str
+            the text column of the dataframe that should be analyzed
+        result_column:str
+            the column where the result will be stored
+        tmp_file_name:str
+            Resulting dataframe will be stored in this file (not stored if None)
+        processes: int
+            amount of worker processes, default: amount of cores / 4
+        threads_per_process: int
+            torch threads per worker, default: amount of cores / processes
+        batch_size: int
+            amount of texts given to the pipeline at once
+        report_every_in_sec: int
+            seconds between two progress outputs
+        token_cache: TokenCache
+            if given, the texts are tokenized once in the main process (or read from the cache)
+            and the workers only run the model
+
+        Returns
+        -------
+        float
+            the throughput in texts per second
+
+        """
+        cpu_count = os.cpu_count() or 1
+        if processes is None:
+            processes = max(1, cpu_count // 4)
+        if threads_per_process is None:
+            threads_per_process = max(1, cpu_count // processes)
+
+        texts = df[text_column].tolist()
+        positions = [i for i, text in enumerate(texts) if not pd.isnull(text)]
+        # longest texts first, dealt round robin to the workers
+        positions.sort(key=lambda i: len(texts[i]), reverse=True)
+        shards = [positions[w::processes] for w in range(processes)]
+
+        context = multiprocessing.get_context('spawn')
+        labels = context.RawArray('b', [-1] * len(texts))
+        scores = context.RawArray('d', len(texts))
+        progress = context.Value('i', 0)
+
+        print(f"Starting {processes} processes with {threads_per_process} threads for {len(positions)} texts.")
+        Tracer.getInstance().event('bert.parallel', processes=processes, threads_per_process=threads_per_process, texts=len(positions))
+        start_time = time.time()
+        workers = []
+        if token_cache is not None:
+            print(f"Tokenized {token_cache.add([texts[i] for i in positions])} new sentences.")
+        for shard in shards:
+            if not shard:
+                continue
+            shard_texts = [texts[i] for i in shard]
+            if token_cache is not None:
+                shard_texts = [np.array(ids) for ids in token_cache.get_ids(shard_texts)]
+            worker = context.Process(target=_sentiment_worker, args=(shard, shard_texts, labels, scores, progress, threads_per_process, batch_size, token_cache is not None))
+            worker.start()
+            workers.append(worker)
+
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(timeout=report_every_in_sec / len(workers))
+                done = progress.value
+                elapsed = time.time() - start_time
+                rate = done / elapsed if elapsed > 0 else 0
+                eta = (len(positions) - done) / rate if rate > 0 else float('nan')
+                print(f"running: {done} of {len(positions)}, {rate:.2f} texts/s, ETA {eta:.0f}s")
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            print(f"Interrupted by user. {progress.value} of {len(positions)} texts calculated.")
+
+        failed = [worker.exitcode for worker in workers if worker.exitcode]
+        if failed:
+            print(f"Worker processes failed with exit codes {failed}")
+
+        # build the result column once, rows without a result keep their old value
+        if result_column in df.columns:
+            results = df[result_column].tolist()
+        else:
+            results = [None] * len(texts)
+        for i in positions:
+            if labels[i] >= 0:
+                results[i] = [{'label': SentimentBert.labels[labels[i]], 'score': scores[i]}]
+        df[result_column] = pd.Series(results, index=df.index, dtype=object)
+
+        elapsed = time.time() - start_time
+        throughput = progress.value / elapsed if elapsed > 0 else 0
+        print(f"Finished {progress.value} texts in {elapsed:.1f}s: {throughput:.2f} texts/s ({throughput / max(1, len(workers)):.2f} per process)")
+        Tracer.getInstance().event('bert.parallel.finished', texts=progress.value, duration_s=elapsed, throughput=throughput)
+        Tracer.getInstance().count('bert.texts', progress.value)
+
+        if tmp_file_name is not None:
+            print("storing file")
+            df.to_csv(tmp_file_name, index=False)
+
+        return throughput
+
+    @staticmethod
+    def get_token_cache(directory:str='token_cache') -> TokenCache:
+        """ returns a token cache for the tokenizer of the model
+
+        Parameters
+        ----------
+        directory:str
+            base directory of the cache
+        """
+        return TokenCache(SentimentBert.tokenizer, directory)
+
+    @staticmethod
+    def predict_token_ids(token_ids:list, batch_size:int=16) -> np.ndarray:
+        """
+        runs the model on already tokenized texts
+
+        Parameters
+        ----------
+        token_ids: list
+            list of token id arrays (e.g. from TokenCache.get_ids)
+        batch_size: int
+            amount of texts given to the model at once
+
+        Returns
+        -------
+        np.ndarray
+            the probabilities per text and label (columns in order of model.config.id2label)
+        """
+        probabilities = []
+        tracer = Tracer.getInstance()
+        progress = tracer.progress('bert batches', -(-len(token_ids) // batch_size))
+        with torch.no_grad():
+            for start in range(0, len(token_ids), batch_size):
+                with tracer.span('bert.batch', texts=len(token_ids[start:start + batch_size])) as span:
+                    batch = SentimentBert.tokenizer.pad({'input_ids': [[int(i) for i in ids] for ids in token_ids[start:start + batch_size]]}, return_tensors='pt')
+                    span['tokens'] = int(batch['attention_mask'].sum())
+                    logits = SentimentBert.model(**batch).logits
+                    probabilities.append(torch.softmax(logits, dim=-1).numpy())
+                progress.update()
+        if not probabilities:
+            return np.zeros((0, SentimentBert.model.config.num_labels), dtype=np.float32)
+        return np.concatenate(probabilities)
+
+    @staticmethod
+    def score_token_ids(token_ids:list, batch_size:int=16) -> list:
+        """
+        returns the sentiment of already tokenized texts in the form of the pipeline
+        [{'label': 'neutral', 'score': 0.5374473929405212}, ...]
+
+        Parameters
+        ----------
+        token_ids: list
+            list of token id arrays (e.g. from TokenCache.get_ids)
+        batch_size: int
+            amount of texts given to the model at once
+        """
+        probabilities = SentimentBert.predict_token_ids(token_ids, batch_size)
+        id2label = SentimentBert.model.config.id2label
+        return [{'label': id2label[int(row.argmax())], 'score': float(row.max())} for row in probabilities]
+
+    @staticmethod
+    def score_text(text:str, token_cache:TokenCache=None) -> list:
+        """
+        returns the sentiment of one text in the form [{'label': 'neutral', 'score': 0.53}]
+
+        Uses the pipeline or, if given, the token ids of the cache
+
+        Parameters
+        ----------
+        text: str
+            the text to analyze
+        token_cache: TokenCache
+            cache of token ids
+        """
+        if token_cache is None:
+            return SentimentBert.sentiment_pipeline(text)
+        return SentimentBert.score_token_ids(token_cache.get_ids([text]))
+
+    @staticmethod
+    def calculate_sentiment_probabilities( df:pd.DataFrame, text_column:str, prefix:str, batch_size:int=16, token_cache:TokenCache=None):
+        """
+        calculates the probabilities of all labels into float32 columns of the data frame
+
+        The columns are named {prefix}_positive, {prefix}_neutral and {prefix}_negative,
+        rows without text get NaN. Use probabilities_to_score to get the score column.
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe to work with
+        text_column:str
+            the text column of the dataframe that should be analyzed
+        prefix:str
+            prefix of the result columns
+        batch_size: int
+            amount of texts given to the model at once
+        token_cache: TokenCache
+            if given, token ids are read from (and stored to) the cache
+
+        """
+        has_text = df[text_column].notna().to_numpy()
+        texts = df.loc[has_text, text_column].tolist()
+        if token_cache is not None:
+            token_ids = token_cache.get_ids(texts)
+        else:
+            token_ids = SentimentBert.tokenizer(texts, truncation=True, max_length=min(SentimentBert.tokenizer.model_max_length, 512))['input_ids']
+
+        probabilities = SentimentBert.predict_token_ids(token_ids, batch_size)
+        for column, label in SentimentBert.model.config.id2label.items():
+            values = np.full(len(df), np.nan, dtype=np.float32)
+            values[has_text] = probabilities[:, column]
+            df[f'{prefix}_{label}'] = values
+
+    @staticmethod
+    def probabilities_to_score(df:pd.DataFrame, prefix:str) -> pd.Series:
+        """
+        Returns the score of the probability columns written by calculate_sentiment_probabilities
+
+        Same rule as sentiment_to_score: the label with the highest probability wins,
+        'neutral' gives 0, 'positive' the probability and 'negative' the negative probability
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe to work with
+        prefix:str
+            prefix of the probability columns
+
+        Returns
+        -------
+        pd.Series
+            the scores as float
+        """
+        positive = df[f'{prefix}_positive'].to_numpy(dtype=np.float64)
+        negative = df[f'{prefix}_negative'].to_numpy(dtype=np.float64)
+        neutral = df[f'{prefix}_neutral'].to_numpy(dtype=np.float64)
+        score = np.where((positive >= negative) & (positive >= neutral), positive,
+                         np.where(negative >= neutral, -negative, 0.0))
+        # keep NaN for rows without a result
+        score[np.isnan(positive)] = np.nan
+        return pd.Series(score, index=df.index)
+
+    @staticmethod
+    def sentiment_column_to_score(sentiment:pd.Series) -> pd.Series:
+        """
+        Returns the scores of a whole column of results in the form
+        "[{'label': 'neutral', 'score': 0.5374473929405212}]"
+
+        Vectorized version of sentiment_to_score, for reading result columns of older csv files
+        (new results: calculate_sentiment_probabilities and probabilities_to_score)
+
+        Parameters
+        ----------
+        sentiment: pd.Series
+            the column with the results (strings or lists)
+
+        Returns
+        -------
+        pd.Series
+            the scores as float
+        """
+        parts = sentiment.astype(str).str.extract(r"'label':\s*'(\w+)',\s*'score':\s*([-+0-9.eE]+)")
+        score = parts[1].astype(float)
+        score = score.where(parts[0] != 'negative', -score)
+        return score.where(parts[0] != 'neutral', 0.0)
+
     def sentiment_to_score(sentiment):
         """
         Returns the score of the sentiment given in the form
@@ -232,9 +574,14 @@ if platform.platform(terse=True)[:5] == "macOS":
 else:
     print( 'Other platform:', platform.platform() )
 
-    SentimentBert.calculate_sentiment_nobreak(df,text_column='Extracted Text',result_column='Sentiment',tmp_file_name='df_korpus_tmp.csv')
-    SentimentBert.calculate_sentiment_nobreak(df,text_column='MigText',result_column='Sentiment_MigText',tmp_file_name='df_korpus_tmp.csv')
+    # both passes (and reruns) share the token ids of the sentences
+    token_cache = SentimentBert.get_token_cache()
+    SentimentBert.calculate_sentiment_probabilities(df,text_column='Extracted Text',prefix='Sentiment',token_cache=token_cache)
+    SentimentBert.calculate_sentiment_probabilities(df,text_column='MigText',prefix='Sentiment_MigText',token_cache=token_cache)
+    df['Sentiment_Score'] = SentimentBert.probabilities_to_score(df,prefix='Sentiment')
+    df['SentiScore_Migtext'] = SentimentBert.probabilities_to_score(df,prefix='Sentiment_MigText')
 
-df['Sentiment_Score'] = df['Sentiment'].apply(SentimentBert.sentiment_to_score)
-df['SentiScore_Migtext'] = df['Sentiment_MigText'].apply(SentimentBert.sentiment_to_score)
+# result columns of older csv files
+df['Sentiment_Score'] = SentimentBert.sentiment_column_to_score(df['Sentiment'])
+df['SentiScore_Migtext'] = SentimentBert.sentiment_column_to_score(df['Sentiment_MigText'])
 """
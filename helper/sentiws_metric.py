@@ -2,6 +2,7 @@ import spacy
 import pandas as pd
 from spacy_sentiws import spaCySentiWS
 from spacy.language import Language
+from helper.instrumentation import Tracer
 
 
 class SentiWS_Metric():
@@ -128,9 +129,12 @@ class SentiWS_Metric():
 
         sentiws_3.used_words={}
 
-        doc=sentiws_3.nlp(text)
+        with Tracer.getInstance().span('sentiws.article', characters=len(text)) as span:
+            doc=sentiws_3.nlp(text)
 
-        result = sentiws_3.analyze_sentiment_ws_tokens(doc)
+            result = sentiws_3.analyze_sentiment_ws_tokens(doc)
+            span['tokens'] = len(doc)
+        Tracer.getInstance().count('sentiws.articles')
         for i in range(len(result)):
             score_doc[i] += result[i]
 
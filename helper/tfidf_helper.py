@@ -1,41 +1,220 @@
+import hashlib
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
 from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.preprocessing import normalize
+from helper.token_store import TokenStore
+from helper.corpus_helper import text_hashes, slice_mask
+from helper.instrumentation import Tracer
 
 
 german_stop_words = stopwords.words('german')
 german_stop_words.extend(['000', 'page', 'de','www','the','http','of', 'nen', 'spiegel','sagt', 'sagte', 'sei','gesamtseiten','taz', 'welt','pdf', 'seit','dpa','zeit', 'seien', '2012', '2013', '2015', '2016', '2023'])
 
-def top_tfidf_terms(df,newspaper, years, top_n=5):
-    # Global IDF values for the entire corpus
-    vectorizer_global = TfidfVectorizer(max_df=0.80, min_df=0.01, stop_words=german_stop_words, use_idf=True)
-    _ = vectorizer_global.fit_transform(df['Extracted Text'])  # Fitting to obtain global IDF values only
 
-    # Filter by newspaper if specified, else use the whole DataFrame
-    if newspaper != 'ALL':
-        filtered_df = df[df['Newspaper'] == newspaper]
-    else:
-        filtered_df = df
+class CorpusTfidf():
+    """ TF-IDF of the whole corpus, fitted once
 
-    # Filter by years if specified
-    if years != 'ALL':
-        filtered_df = filtered_df[filtered_df['Year'].isin(years)]
+    The corpus is tokenized once, the global IDF values and the sparse document-term matrix are kept.
+    Every row is the l2 normalized term frequency multiplied by the global IDF,
+    so the mean over the rows of a slice (newspaper/years) is the same as fitting a local vectorizer
+    without IDF on the slice and applying the global IDF values (former top_tfidf_terms).
+    The top terms of a slice are memoized.
+    Nothing is densified: slice means are sparse products, the top terms are selected by argpartition.
+    """
 
-    # Extracted text from the filtered subset
-    filtered_articles = filtered_df['Extracted Text']
+    def __init__(self, df:pd.DataFrame, max_df:float=0.80, min_df:float=0.01, stop_words:list=german_stop_words, token_store:TokenStore=None):
+        """
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe with the columns 'Extracted Text', 'Newspaper' and 'Year'
+        max_df: float
+            terms found in more documents (share) are ignored
+        min_df: float
+            terms found in less documents (share) are ignored
+        stop_words: list
+            words to ignore
+        token_store: TokenStore
+            if given, the lowercase spaCy tokens of the store (built from the same dataframe) are used
+            instead of tokenizing the texts again. Every spaCy token is split like the default token pattern
+            of sklearn, so the terms are nearly the same.
+        """
+        with Tracer.getInstance().span('tfidf.fit', documents=len(df), token_store=token_store is not None) as span:
+            if token_store is not None:
+                if not token_store.matches(df):
+                    raise ValueError('The token store does not contain the texts of the dataframe')
+                counter = CountVectorizer(max_df=max_df, min_df=min_df, analyzer=CorpusTfidf.store_analyzer(token_store, stop_words))
+                counts = counter.fit_transform(range(len(token_store)))
+            else:
+                counter = CountVectorizer(max_df=max_df, min_df=min_df, stop_words=stop_words)
+                counts = counter.fit_transform(df['Extracted Text'])
 
-    # Local vectorizer without recalculating IDF values
-    vectorizer_local = TfidfVectorizer(vocabulary=vectorizer_global.vocabulary_, stop_words=german_stop_words, use_idf=False)
-    tf_matrix = vectorizer_local.fit_transform(filtered_articles)
+            self.idf = TfidfTransformer(use_idf=True).fit(counts).idf_
+            self.feature_names = counter.get_feature_names_out()
+            self.matrix = normalize(counts, norm='l2').multiply(self.idf).tocsr()
+            span['terms'] = len(self.feature_names)
+            span['nonzero'] = self.matrix.nnz
+        self.newspapers = df['Newspaper'].to_numpy()
+        self.years = df['Year'].to_numpy()
+        self.fingerprint = CorpusTfidf.corpus_fingerprint(df)
+        self.token_store = token_store
+        self._top_terms = {}
 
-    # Apply global IDF values and calculate TF-IDF for the subset
-    tfidf_matrix = tf_matrix.multiply(vectorizer_global.idf_)
+    @staticmethod
+    def store_analyzer(token_store:TokenStore, stop_words:list):
+        """ returns an analyzer for CountVectorizer that gets article numbers of the token store """
+        token_pattern = re.compile(r'(?u)\b\w\w+\b')
+        stop_words = set(stop_words)
+        # terms per string id, calculated once per vocabulary entry
+        terms = {}
+        def analyze(row:int) -> list:
+            result = []
+            for i in token_store.lower[token_store.offsets[row]:token_store.offsets[row + 1]]:
+                if i not in terms:
+                    terms[i] = [term for term in token_pattern.findall(token_store.strings[i]) if term not in stop_words]
+                result.extend(terms[i])
+            return result
+        return analyze
 
-    # Determine top terms
-    feature_names = vectorizer_global.get_feature_names_out()
-    dense_matrix = tfidf_matrix.todense()
-    tfidf_means = dense_matrix.mean(axis=0).tolist()[0]
-    term_scores = [(feature_names[i], tfidf_means[i]) for i in range(len(feature_names))]
-    sorted_term_scores = sorted(term_scores, key=lambda x: x[1], reverse=True)
+    @staticmethod
+    def corpus_fingerprint(df:pd.DataFrame) -> str:
+        """ returns a hash of texts, newspapers and years of the dataframe """
+        hashes = text_hashes(df, ['Extracted Text', 'Newspaper', 'Year'])
+        return hashlib.sha1(hashes.tobytes()).hexdigest()
 
-    return sorted_term_scores[:top_n]
+    @staticmethod
+    def slice_key(newspaper:str, years:list|str) -> tuple:
+        return (newspaper, years if years == 'ALL' else tuple(sorted(years)))
 
+    @staticmethod
+    def top_k(values:np.ndarray, top_n:int) -> np.ndarray:
+        """ returns the indices of the top_n largest values, largest first
+
+        Uses argpartition instead of sorting all values, equal values keep the order of their index
+        """
+        if top_n <= 0:
+            return np.array([], dtype=np.int64)
+        if top_n >= len(values):
+            return np.lexsort((np.arange(len(values)), -values))
+        candidates = np.argpartition(-values, top_n - 1)[:top_n]
+        # values equal to the smallest selected value might be cut arbitrarily by argpartition
+        threshold = values[candidates].min()
+        candidates = np.flatnonzero(values >= threshold)
+        return candidates[np.lexsort((candidates, -values[candidates]))][:top_n]
+
+    def rows(self, newspaper:str, years:list|str) -> np.ndarray:
+        """ returns the row numbers of the slice
+
+        Parameters
+        ----------
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+        """
+        return np.flatnonzero(slice_mask(self.newspapers, self.years, newspaper, years))
+
+    def slice_weights(self, slices:list) -> sparse.csr_matrix:
+        """ returns a sparse (slices x documents) matrix, each row averages the documents of one slice
+
+        Parameters
+        ----------
+        slices: list
+            list of (newspaper, years)
+        """
+        row_ids, column_ids, values = [], [], []
+        for i, (newspaper, years) in enumerate(slices):
+            rows = self.rows(newspaper, years)
+            row_ids.append(np.full(len(rows), i))
+            column_ids.append(rows)
+            values.append(np.full(len(rows), 1 / len(rows) if len(rows) else 0.0))
+        return sparse.csr_matrix((np.concatenate(values), (np.concatenate(row_ids), np.concatenate(column_ids))), shape=(len(slices), self.matrix.shape[0]))
+
+    def mean_tfidf(self, newspaper:str, years:list|str) -> np.ndarray:
+        """ returns the mean TF-IDF value per term of the slice """
+        return (self.slice_weights([(newspaper, years)]) @ self.matrix).toarray().ravel()
+
+    def top_terms(self, newspaper:str, years:list|str, top_n:int=5) -> list:
+        """ returns the top_n terms of the slice as list of (term, mean TF-IDF)
+
+        Parameters
+        ----------
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+        top_n : int
+            amount of terms
+        """
+        return self.top_terms_batch([(newspaper, years)], top_n)[CorpusTfidf.slice_key(newspaper, years)]
+
+    def all_slices(self) -> list:
+        """ returns all slices: every newspaper per year, every newspaper, every year and the whole corpus """
+        newspapers = sorted(set(self.newspapers))
+        years = sorted(set(self.years))
+        slices = [(newspaper, [year]) for newspaper in newspapers for year in years]
+        slices += [(newspaper, 'ALL') for newspaper in newspapers]
+        slices += [('ALL', [year]) for year in years]
+        return slices + [('ALL', 'ALL')]
+
+    def top_terms_batch(self, slices:list=None, top_n:int=5) -> dict:
+        """ returns the top terms of many slices, the means of all slices are one sparse matrix product
+
+        Parameters
+        ----------
+        slices: list
+            list of (newspaper, years), default: all_slices()
+        top_n : int
+            amount of terms
+
+        Returns
+        -------
+        dict
+            (newspaper, years) -> list of (term, mean TF-IDF), years given as sorted tuple or 'ALL'
+        """
+        if slices is None:
+            slices = self.all_slices()
+        keys = [CorpusTfidf.slice_key(newspaper, years) for newspaper, years in slices]
+        missing = [(key, part) for key, part in zip(keys, slices) if (key, top_n) not in self._top_terms]
+        if missing:
+            with Tracer.getInstance().span('tfidf.top_terms', slices=len(missing), top_n=top_n):
+                means = (self.slice_weights([part for _, part in missing]) @ self.matrix).tocsr()
+                for i, (key, _) in enumerate(missing):
+                    row = means.getrow(i).toarray().ravel()
+                    self._top_terms[(key, top_n)] = [(self.feature_names[j], float(row[j])) for j in CorpusTfidf.top_k(row, top_n)]
+        return {key: self._top_terms[(key, top_n)] for key in keys}
+
+
+# the corpus of the last call of top_tfidf_terms
+_corpus_tfidf = None
+
+def get_corpus_tfidf(df:pd.DataFrame, token_store:TokenStore=None) -> CorpusTfidf:
+    """ returns the fitted CorpusTfidf of the dataframe, fitted again only if the corpus changed """
+    global _corpus_tfidf
+    if _corpus_tfidf is None or _corpus_tfidf.fingerprint != CorpusTfidf.corpus_fingerprint(df) or _corpus_tfidf.token_store is not token_store:
+        _corpus_tfidf = CorpusTfidf(df, token_store=token_store)
+    return _corpus_tfidf
+
+def top_tfidf_terms(df,newspaper, years, top_n=5, token_store:TokenStore=None):
+    """ Returns the top terms (term, mean TF-IDF) of a newspaper and/or years
+
+    IDF values are taken from the entire corpus, the corpus is fitted once and reused by later calls
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        the dataframe to work with
+    newspaper:str
+        either a valid newspaper or 'ALL'
+    years:list|str
+        either a list of years [2012,2013]  or 'ALL'
+    top_n : int
+        amount of terms
+    token_store: TokenStore
+        if given, the tokens of the store are used instead of tokenizing the texts
+    """
+    return get_corpus_tfidf(df, token_store).top_terms(newspaper, years, top_n)
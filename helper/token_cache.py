@@ -0,0 +1,174 @@
+import os
+import hashlib
+import numpy as np
+import transformers
+from helper.corpus_helper import split_sentences
+
+
+class TokenCache():
+    """ class to store token ids of sentences on disk, so every sentence is tokenized only once
+
+    Texts are split into sentences like PdfNewsReader.extract_migration_sentences does. The ids of every
+    sentence (without special tokens) are stored in one int32 file which is read memory mapped,
+    an index file maps the hash of a sentence to offset and length of its ids.
+    The input of a text is [CLS] + ids of its sentences + [SEP], truncated to max_length. The WordPiece
+    tokenizer of the model never joins characters across whitespace, so this equals tokenizing the whole text.
+    MigText consists of sentences of the article, so the MigText pass finds its sentences in the cache
+    after the pass on 'Extracted Text' (and reruns after a crash find everything).
+    The cache directory contains a sub directory per tokenizer version (name, class, transformers version,
+    vocabulary size and max length), so a new tokenizer never reads old ids.
+    """
+
+    index_dtype = np.dtype([('hash', np.uint64), ('offset', np.int64), ('length', np.int32)])
+
+    def __init__(self, tokenizer, directory:str='token_cache', max_length:int=None):
+        """
+        Parameters
+        ----------
+        tokenizer:
+            the (huggingface) tokenizer to use
+        directory:str
+            base directory of the cache
+        max_length:int
+            texts are truncated to this amount of tokens, default: model_max_length of the tokenizer (max 512)
+        """
+        if max_length is None:
+            max_length = min(tokenizer.model_max_length, 512)
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        # room for [CLS] and [SEP]
+        self.content_length = max_length - 2
+
+        version = f'{tokenizer.name_or_path}|{type(tokenizer).__name__}|{transformers.__version__}|{len(tokenizer)}|{max_length}|sentences'
+        self.directory = os.path.join(directory, hashlib.sha1(version.encode('utf-8')).hexdigest()[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.ids_file_name = os.path.join(self.directory, 'ids.int32')
+        self.index_file_name = os.path.join(self.directory, 'index.npy')
+
+        with open(os.path.join(self.directory, 'version.txt'), 'w') as file:
+            file.write(version)
+
+        if os.path.exists(self.index_file_name):
+            index = np.load(self.index_file_name)
+            self.index = dict(zip(index['hash'].tolist(), zip(index['offset'].tolist(), index['length'].tolist())))
+        else:
+            self.index = {}
+        self._ids = None
+
+    @staticmethod
+    def text_hash(text:str) -> int:
+        """ returns the key of a sentence in the cache """
+        return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def sentences(self, text:str) -> list:
+        """ returns the sentences of a text that can end up in the (truncated) input
+
+        Every word gives at least one token, sentences after max_length words are never needed.
+        """
+        sentences = []
+        words = 0
+        for sentence in split_sentences(text):
+            sentences.append(sentence)
+            words += len(sentence.split())
+            if words >= self.content_length:
+                break
+        return sentences
+
+    def _memmap(self):
+        # the file can not be mapped while it is empty
+        if self._ids is None and os.path.exists(self.ids_file_name) and os.path.getsize(self.ids_file_name) > 0:
+            self._ids = np.memmap(self.ids_file_name, dtype=np.int32, mode='r')
+        return self._ids
+
+    def _save_index(self):
+        index = np.empty(len(self.index), dtype=TokenCache.index_dtype)
+        index['hash'] = list(self.index.keys())
+        offsets_lengths = np.array(list(self.index.values()), dtype=np.int64).reshape(-1, 2)
+        index['offset'] = offsets_lengths[:, 0]
+        index['length'] = offsets_lengths[:, 1]
+        tmp_file_name = self.index_file_name + '.tmp'
+        with open(tmp_file_name, 'wb') as file:
+            np.save(file, index)
+        os.replace(tmp_file_name, self.index_file_name)
+
+    def _tokenize(self, missing:dict, batch_size:int=1000) -> int:
+        """ tokenizes the sentences of missing (hash -> sentence), appends the ids and stores the index once """
+        if not missing:
+            return 0
+        keys = list(missing.keys())
+        offset = os.path.getsize(self.ids_file_name) // 4 if os.path.exists(self.ids_file_name) else 0
+        with open(self.ids_file_name, 'ab') as file:
+            for start in range(0, len(keys), batch_size):
+                batch_keys = keys[start:start + batch_size]
+                encoded = self.tokenizer([missing[key] for key in batch_keys], add_special_tokens=False,
+                                         truncation=True, max_length=self.content_length)['input_ids']
+                for key, ids in zip(batch_keys, encoded):
+                    np.asarray(ids, dtype=np.int32).tofile(file)
+                    self.index[key] = (offset, len(ids))
+                    offset += len(ids)
+        # the file grew, map it again on next access
+        self._ids = None
+        self._save_index()
+        return len(keys)
+
+    def _sentence_keys(self, texts:list, missing:dict) -> list:
+        """ returns the sentence hashes of every text, unknown sentences are collected in missing """
+        text_keys = []
+        for text in texts:
+            keys = []
+            for sentence in self.sentences(text):
+                key = TokenCache.text_hash(sentence)
+                if key not in self.index:
+                    missing[key] = sentence
+                keys.append(key)
+            text_keys.append(keys)
+        return text_keys
+
+    def add(self, texts:list, batch_size:int=1000) -> int:
+        """ tokenizes all sentences of the texts that are not yet in the cache
+
+        Parameters
+        ----------
+        texts:list
+            the texts to tokenize
+        batch_size:int
+            amount of sentences given to the tokenizer at once
+
+        Returns
+        -------
+        int
+            the amount of newly tokenized sentences
+        """
+        missing = {}
+        self._sentence_keys(texts, missing)
+        return self._tokenize(missing, batch_size)
+
+    def get_ids(self, texts:list) -> list:
+        """ returns the token ids of the texts (with special tokens, truncated), tokenizes sentences not found in the cache
+
+        Parameters
+        ----------
+        texts:list
+            the texts
+
+        Returns
+        -------
+        list
+            a list of int32 arrays
+        """
+        missing = {}
+        text_keys = self._sentence_keys(texts, missing)
+        self._tokenize(missing)
+        ids = self._memmap()
+        result = []
+        for keys in text_keys:
+            parts = []
+            for key in keys:
+                offset, length = self.index[key]
+                parts.append(ids[offset:offset + length])
+            content = np.concatenate(parts)[:self.content_length] if parts and ids is not None else np.zeros(0, dtype=np.int32)
+            result.append(np.concatenate(([self.tokenizer.cls_token_id], content, [self.tokenizer.sep_token_id])).astype(np.int32))
+        return result
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import string
+import numpy as np
+import pandas as pd
+import spacy
+from helper.corpus_helper import text_hashes, slice_mask
+
+
+# bits of the flags array
+FLAG_STOP = 1
+FLAG_PUNCT = 2
+# token.text.strip() in string.punctuation (also true for whitespace tokens)
+FLAG_PUNCT_TEXT = 4
+
+
+class TokenStore():
+    """ class to keep the spaCy tokens of the corpus on disk
+
+    Every article is parsed once by spaCy, the tokens are stored as integer arrays
+    (lemma, lowercase form, POS and stop/punctuation flags) with one shared vocabulary.
+    The arrays are memory mapped when loading, the tokens of article i are
+    offsets[i]:offsets[i+1] of every array.
+    Word2Vec, TF-IDF and the noun counter read their tokens from here, so slicing by newspaper/year
+    needs no further NLP work.
+
+    Files in the directory
+        offsets.npy, lemma.npy, lower.npy, pos.npy, flags.npy, lemma_lower.npy, text_hashes.npy
+        vocab.json (strings and POS tags), meta.json (newspaper and year per article, spaCy versions)
+    """
+
+    arrays = ['offsets', 'lemma', 'lower', 'pos', 'flags', 'lemma_lower', 'text_hashes']
+
+    def __init__(self, directory:str='token_store'):
+        """ loads a store built by TokenStore.build
+
+        Parameters
+        ----------
+        directory:str
+            the directory of the store
+        """
+        self.directory = directory
+        for name in TokenStore.arrays:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(directory, 'vocab.json'), 'r', encoding='utf-8') as file:
+            vocab = json.load(file)
+        self.strings = vocab['strings']
+        self.pos_tags = vocab['pos']
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+        self.newspapers = np.array(self.meta['newspapers'], dtype=object)
+        self.years = np.array(self.meta['years'])
+        self._string_ids = None
+
+    @staticmethod
+    def build(df:pd.DataFrame, directory:str='token_store', nlp=None, text_column:str='Extracted Text', batch_size:int=64, n_process:int=1):
+        """ parses all texts once with spaCy and stores the tokens
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe with the texts and the columns 'Newspaper' and 'Year'
+        directory:str
+            the directory of the store
+        nlp:
+            nlp loaded by spacy, default: spacy.load('de_core_news_sm')
+        text_column:str
+            the text column of the dataframe
+        batch_size:int
+            batch size of nlp.pipe
+        n_process:int
+            amount of processes of nlp.pipe
+
+        Returns
+        -------
+        TokenStore
+            the loaded store
+        """
+        if nlp is None:
+            nlp = spacy.load('de_core_news_sm')
+        os.makedirs(directory, exist_ok=True)
+
+        string_ids = {}
+        pos_ids = {}
+        def string_id(text:str) -> int:
+            if text not in string_ids:
+                string_ids[text] = len(string_ids)
+            return string_ids[text]
+
+        offsets = [0]
+        lemma, lower, pos, flags = [], [], [], []
+        texts = df[text_column].fillna('').tolist()
+        for i, doc in enumerate(nlp.pipe(texts, disable=['parser', 'ner'], batch_size=batch_size, n_process=n_process)):
+            for token in doc:
+                lemma.append(string_id(token.lemma_))
+                lower.append(string_id(token.lower_))
+                pos.append(pos_ids.setdefault(token.pos_, len(pos_ids)))
+                flags.append((FLAG_STOP if token.is_stop else 0) | (FLAG_PUNCT if token.is_punct else 0)
+                             | (FLAG_PUNCT_TEXT if token.text.strip() in string.punctuation else 0))
+            offsets.append(len(lemma))
+            if i % 1000 == 0:
+                print(f"Tokenized {i} of {len(texts)}")
+
+        # id of the lowercase form of every string (Word2Vec uses lowercase lemmas)
+        lemma_lower = [string_id(text.lower()) for text in list(string_ids.keys())]
+        # strings added by the line above are lowercase already
+        lemma_lower.extend(range(len(lemma_lower), len(string_ids)))
+        lemma_lower = np.array(lemma_lower, dtype=np.int32)
+        strings = list(string_ids.keys())
+
+        np.save(os.path.join(directory, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(directory, 'lemma.npy'), np.array(lemma, dtype=np.int32))
+        np.save(os.path.join(directory, 'lower.npy'), np.array(lower, dtype=np.int32))
+        np.save(os.path.join(directory, 'pos.npy'), np.array(pos, dtype=np.uint8))
+        np.save(os.path.join(directory, 'flags.npy'), np.array(flags, dtype=np.uint8))
+        np.save(os.path.join(directory, 'lemma_lower.npy'), lemma_lower)
+        np.save(os.path.join(directory, 'text_hashes.npy'), text_hashes(df, text_column))
+        with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf-8') as file:
+            json.dump({'strings': strings, 'pos': list(pos_ids.keys())}, file, ensure_ascii=False)
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump({'newspapers': df['Newspaper'].tolist(), 'years': [int(year) for year in df['Year']],
+                       'text_column': text_column, 'spacy': spacy.__version__, 'model': f"{nlp.meta['lang']}_{nlp.meta['name']}-{nlp.meta['version']}"}, file)
+        print(f"Stored {len(lemma)} tokens of {len(texts)} texts in {directory}")
+        return TokenStore(directory)
+
+    @staticmethod
+    def load_or_build(df:pd.DataFrame, directory:str='token_store', nlp=None, text_column:str='Extracted Text'):
+        """ loads the store, builds it again if it does not exist or does not match the texts of the dataframe """
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            store = TokenStore(directory)
+            if store.matches(df, text_column):
+                return store
+            print(f"Token store {directory} does not match the corpus, building again")
+        return TokenStore.build(df, directory, nlp, text_column)
+
+    def matches(self, df:pd.DataFrame, text_column:str='Extracted Text') -> bool:
+        """ returns True if the store contains exactly the texts of the dataframe (same order) """
+        return len(df) == len(self.text_hashes) and bool(np.array_equal(text_hashes(df, text_column), self.text_hashes))
+
+    @property
+    def fingerprint(self) -> str:
+        """ a short hash of all texts of the store (corpus version) """
+        return hashlib.sha1(np.ascontiguousarray(self.text_hashes).tobytes()).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def string_id(self, text:str) -> int:
+        """ returns the id of a string or -1 if unknown """
+        if self._string_ids is None:
+            self._string_ids = {text: i for i, text in enumerate(self.strings)}
+        return self._string_ids.get(text, -1)
+
+    def pos_id(self, tag:str) -> int:
+        return self.pos_tags.index(tag) if tag in self.pos_tags else -1
+
+    def rows(self, newspaper:str='ALL', years:list|str='ALL') -> np.ndarray:
+        """ returns the article numbers of a newspaper and/or years
+
+        Parameters
+        ----------
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+        """
+        return np.flatnonzero(slice_mask(self.newspapers, self.years, newspaper, years))
+
+    def positions(self, rows:np.ndarray=None) -> np.ndarray:
+        """ returns the token positions of all tokens of the given articles (default: all) """
+        if rows is None:
+            return np.arange(self.offsets[-1])
+        rows = np.asarray(rows)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        # start of every article repeated per token plus the position inside the article
+        shift = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return shift + np.arange(lengths.sum())
+
+    def word2vec_ids(self, row:int) -> np.ndarray:
+        """ returns the lowercase lemma ids of an article without stop words and punctuation """
+        start, end = self.offsets[row], self.offsets[row + 1]
+        keep = (self.flags[start:end] & (FLAG_STOP | FLAG_PUNCT | FLAG_PUNCT_TEXT)) == 0
+        return self.lemma_lower[self.lemma[start:end][keep]]
+
+    def word2vec_tokens(self, row:int) -> list:
+        """ returns the tokens of an article as word2vec_helper.preprocess_text does """
+        return [self.strings[i] for i in self.word2vec_ids(row)]
+
+    def lower_tokens(self, row:int) -> list:
+        """ returns the lowercase forms of all tokens of an article """
+        return [self.strings[i] for i in self.lower[self.offsets[row]:self.offsets[row + 1]]]
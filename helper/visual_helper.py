@@ -1,10 +1,191 @@
+import weakref
+import hashlib
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
 
-def average_score(df,years, newspaper, score_column:str):
+class ScoreCube():
+    """ pre-aggregated score statistics per newspaper, year and month
+
+    For every score column the cube keeps count, sum, sum of squares, min and max per cell,
+    plus the sums needed for a linear trend over the articles with a score other than zero
+    (count, sum x, sum x², sum y, sum y², sum xy with x = days of the publication date).
+    Averages and trend lines of any newspaper/year selection are calculated from the cells,
+    the same values as filtering the dataframe and using mean() or np.polyfit.
+    The cube is built by one groupby and can be updated with new articles.
+    """
+
+    keys = ['Newspaper', 'Year', 'Month']
+    # x is stored relative to this date (numeric stability of the sums of squares)
+    x_origin = mdates.date2num(pd.Timestamp('2000-01-01'))
+
+    def __init__(self, df:pd.DataFrame=None, score_columns:list=None):
+        """
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe with 'Newspaper', 'Year', 'Publication Date' and the score columns
+        score_columns: list
+            the columns to aggregate, default: all float columns
+        """
+        self.score_columns = []
+        self.cells = None
+        if df is not None:
+            self.update(df, score_columns)
+
+    @staticmethod
+    def _aggregations(columns:list) -> dict:
+        aggregations = {}
+        for column in columns:
+            for stat in ['count', 'sum', 'sumsq', 'nz_count', 'nz_x', 'nz_xx', 'nz_y', 'nz_yy', 'nz_xy']:
+                aggregations[f'{column}__{stat}'] = 'sum'
+            aggregations[f'{column}__min'] = 'min'
+            aggregations[f'{column}__max'] = 'max'
+        return aggregations
+
+    @staticmethod
+    def aggregate(df:pd.DataFrame, score_columns:list) -> pd.DataFrame:
+        """ returns the cells of the given articles """
+        dates = pd.to_datetime(df['Publication Date'])
+        frame = pd.DataFrame({'Newspaper': df['Newspaper'], 'Year': df['Year'], 'Month': dates.dt.month}, index=df.index)
+        x = pd.Series(mdates.date2num(dates) - ScoreCube.x_origin, index=df.index)
+        for column in score_columns:
+            y = df[column].astype(float)
+            valid = y.notna()
+            nonzero = valid & (y != 0) & x.notna()
+            frame[f'{column}__count'] = valid.astype(int)
+            frame[f'{column}__sum'] = y.where(valid, 0.0)
+            frame[f'{column}__sumsq'] = y.where(valid, 0.0) ** 2
+            frame[f'{column}__min'] = y
+            frame[f'{column}__max'] = y
+            frame[f'{column}__nz_count'] = nonzero.astype(int)
+            frame[f'{column}__nz_x'] = x.where(nonzero, 0.0)
+            frame[f'{column}__nz_xx'] = x.where(nonzero, 0.0) ** 2
+            frame[f'{column}__nz_y'] = y.where(nonzero, 0.0)
+            frame[f'{column}__nz_yy'] = y.where(nonzero, 0.0) ** 2
+            frame[f'{column}__nz_xy'] = (x * y).where(nonzero, 0.0)
+        return frame.groupby(ScoreCube.keys, dropna=False).agg(ScoreCube._aggregations(score_columns))
+
+    def update(self, df:pd.DataFrame, score_columns:list=None):
+        """ adds articles to the cube
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the new articles
+        score_columns: list
+            the columns to aggregate, default: the columns of the cube (all float columns for an empty cube)
+        """
+        if score_columns is None:
+            score_columns = self.score_columns or [c for c in df.columns if pd.api.types.is_float_dtype(df[c]) and c not in ScoreCube.keys]
+        if self.cells is not None and set(score_columns) != set(self.score_columns):
+            raise ValueError(f'The cube contains the columns {self.score_columns}')
+        cells = ScoreCube.aggregate(df, score_columns)
+        if self.cells is not None:
+            # combine the cells: sums are added, min/max of both
+            cells = pd.concat([self.cells, cells]).groupby(level=ScoreCube.keys, dropna=False).agg(ScoreCube._aggregations(score_columns))
+        self.cells = cells
+        self.score_columns = list(score_columns)
+
+    def select(self, years:list|str='ALL', newspaper:str='ALL') -> pd.DataFrame:
+        """ returns the cells of a newspaper and/or years
+
+        Parameters
+        ----------
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        """
+        cells = self.cells
+        if newspaper != 'ALL':
+            cells = cells[cells.index.get_level_values('Newspaper') == newspaper]
+        if years != 'ALL':
+            cells = cells[cells.index.get_level_values('Year').isin(years)]
+        return cells
+
+    def _check_column(self, column:str):
+        if column not in self.score_columns:
+            raise KeyError(f'{column} is not part of the cube, columns: {self.score_columns}')
+
+    def mean(self, column:str, years:list|str='ALL', newspaper:str='ALL') -> float:
+        """ returns the mean of the column for a newspaper and/or years (NaN if there are no values) """
+        self._check_column(column)
+        cells = self.select(years, newspaper)
+        count = cells[f'{column}__count'].sum()
+        return cells[f'{column}__sum'].sum() / count if count else np.nan
+
+    def summary(self, column:str, by:list=['Year']) -> pd.DataFrame:
+        """ returns count, mean, std, min and max of the column grouped by some of the keys """
+        self._check_column(column)
+        grouped = self.cells.groupby(level=by, dropna=False).agg(ScoreCube._aggregations([column]))
+        count = grouped[f'{column}__count']
+        mean = grouped[f'{column}__sum'] / count
+        # sample standard deviation like pandas std()
+        variance = (grouped[f'{column}__sumsq'] - count * mean ** 2) / (count - 1)
+        return pd.DataFrame({'count': count, 'mean': mean, 'std': np.sqrt(variance.clip(lower=0)),
+                             'min': grouped[f'{column}__min'], 'max': grouped[f'{column}__max']})
+
+    def trend(self, column:str, start_year:int, end_year:int, newspaper:str='ALL') -> np.poly1d:
+        """ returns the linear trend of the column over the articles with a score other than zero
+
+        Same result as np.polyfit(mdates.date2num(dates), scores, 1) of the filtered articles (see show_plt_year)
+
+        Returns
+        -------
+        np.poly1d
+            the trend line, x in matplotlib date numbers
+        """
+        slope, intercept, _ = self._trend_stats(column, start_year, end_year, newspaper)
+        return np.poly1d([slope, intercept - slope * ScoreCube.x_origin])
+
+    def _trend_stats(self, column:str, start_year:int, end_year:int, newspaper:str='ALL') -> tuple:
+        self._check_column(column)
+        cells = self.select(list(range(start_year, end_year + 1)), newspaper)
+        n, sx, sxx, sy, syy, sxy = (cells[f'{column}__{stat}'].sum() for stat in ['nz_count', 'nz_x', 'nz_xx', 'nz_y', 'nz_yy', 'nz_xy'])
+        # centered sums
+        cxx = sxx - sx ** 2 / n
+        cxy = sxy - sx * sy / n
+        cyy = syy - sy ** 2 / n
+        slope = cxy / cxx
+        intercept = (sy - slope * sx) / n
+        residual_variance = max(cyy - slope * cxy, 0) / (n - 2) if n > 2 else np.nan
+        return slope, intercept, {'n': n, 'mean_x': sx / n, 'cxx': cxx, 'residual_variance': residual_variance}
+
+    def trend_band(self, column:str, start_year:int, end_year:int, dates, newspaper:str='ALL', z:float=1.96) -> tuple:
+        """ returns the trend line and its confidence band (of the mean) at the given dates
+
+        Returns
+        -------
+        tuple
+            (trend, lower, upper) as numpy arrays
+        """
+        slope, intercept, stats = self._trend_stats(column, start_year, end_year, newspaper)
+        x = mdates.date2num(dates) - ScoreCube.x_origin
+        trend = intercept + slope * x
+        error = z * np.sqrt(stats['residual_variance'] * (1 / stats['n'] + (x - stats['mean_x']) ** 2 / stats['cxx']))
+        return trend, trend - error, trend + error
+
+
+# time bucket statistics of show_plt_year for the last dataframe,
+# (column, start_year, end_year, freq) -> (version of the used columns, DataFrame)
+_bucket_cache = {}
+_bucket_cache_frame = None
+
+def _frame_key(df:pd.DataFrame) -> tuple:
+    # identity and shape of the dataframe, checked without reading the data
+    return (weakref.ref(df), df.shape)
+
+def _same_frame(key:tuple, df:pd.DataFrame) -> bool:
+    return key is not None and key[0]() is df and key[1] == df.shape
+
+def _columns_version(df:pd.DataFrame, columns:list) -> str:
+    # hash of the values, detects columns changed in place (much cheaper than the aggregation)
+    return hashlib.sha1(pd.util.hash_pandas_object(df[columns], index=False).to_numpy().tobytes()).hexdigest()
+
+def average_score(df,years, newspaper, score_column:str, cube:ScoreCube=None):
     """
     prints the average of the dataframe for the given column
 
@@ -17,47 +198,124 @@ def average_score(df,years, newspaper, score_column:str):
     newspaper:str
         either a valid newspaper or 'ALL'
     score_column : sttr
-        The column to use for mean value 
+        The column to use for mean value
+    cube: ScoreCube
+        pre-aggregated scores of the dataframe (build it once with ScoreCube(df) for several calls),
+        default: a cube of the score column is built
 
     """
-    # Filter the DataFrame based on 'newspaper' and 'years', if they are not 'ALL'
-    if newspaper != 'ALL':
-        df_filtered = df[df['Newspaper'] == newspaper]
-    else:
-        df_filtered = df
+    if cube is None:
+        cube = ScoreCube(df, [score_column])
 
-    if years != 'ALL':
-        df_filtered = df_filtered[df_filtered['Year'].isin(years)]
-    
     # Calculate the average score
-    average_score_value = df_filtered[score_column].mean()
-    
+    average_score_value = cube.mean(score_column, years, newspaper)
+
     # Print out the results in a formatted string
     newspaper_text = f"for {newspaper}" if newspaper != 'ALL' else "for all newspapers"
     years_text = f"in the year(s) {', '.join(map(str, years))}" if years != 'ALL' else "for all years"
     print(f"The average {score_column} score {newspaper_text} {years_text} is: {average_score_value:.2f}")
 
-def show_plt_year(df,start_year, end_year, column='Sentiment_Score'):
-    # Filter data between start_year and end_year and remove articles with a sentiment score of zero
-    df_filtered = df[
-        (df['Year'] >= start_year) & 
-        (df['Year'] <= end_year) & 
-        (df[column] != 0)
-    ]
-    
-    # Ensure the 'Publication Date' is in datetime format
-    #df_filtered['Publication Date'] = pd.to_datetime(df_filtered['Publication Date'])
-
-    # Scatter plot with each article as a point
+def bucket_stats(df:pd.DataFrame, start_year:int, end_year:int, column:str='Sentiment_Score', freq:str='W', refresh:bool=False) -> pd.DataFrame:
+    """
+    returns count, mean and 95% confidence interval of the mean per time bucket
+    of the articles between start_year and end_year (score zero excluded)
+
+    Cached per parameters for the last dataframe only (same object and shape),
+    a cached result is only used while the values of the used columns are unchanged
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        the dataframe to work with
+    start_year:int
+        first year
+    end_year:int
+        last year
+    column:str
+        the score column
+    freq:str
+        pandas frequency of the buckets, e.g. 'D', 'W', 'ME' (month end)
+    """
+    global _bucket_cache, _bucket_cache_frame
+    if refresh or not _same_frame(_bucket_cache_frame, df):
+        _bucket_cache = {}
+        _bucket_cache_frame = _frame_key(df)
+    key = (column, start_year, end_year, freq)
+    version = _columns_version(df, ['Year', 'Publication Date', column])
+    if key not in _bucket_cache or _bucket_cache[key][0] != version:
+        df_filtered = df[(df['Year'] >= start_year) & (df['Year'] <= end_year) & (df[column] != 0)]
+        grouped = df_filtered.groupby(pd.Grouper(key='Publication Date', freq=freq))[column].agg(['count', 'mean', 'std'])
+        grouped = grouped[grouped['count'] > 0]
+        error = 1.96 * grouped['std'].fillna(0) / np.sqrt(grouped['count'])
+        grouped['lower'] = grouped['mean'] - error
+        grouped['upper'] = grouped['mean'] + error
+        _bucket_cache[key] = (version, grouped)
+    return _bucket_cache[key][1]
+
+def show_plt_year(df,start_year, end_year, column='Sentiment_Score', cube:ScoreCube=None, mode:str='scatter', freq:str='W', gridsize:int=100):
+    """
+    shows the scores of the articles between start_year and end_year (score zero excluded) with a linear trend line
+
+    For large corpora use mode 'binned' or 'hexbin', the rendering then depends on the amount of buckets
+    and not on the amount of articles:
+        scatter: every article is a point
+        binned: mean and 95% confidence interval per time bucket (freq), trend line with confidence band
+        hexbin: density of the articles
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        the dataframe to work with
+    start_year:int
+        first year
+    end_year:int
+        last year
+    column:str
+        the score column
+    cube: ScoreCube
+        pre-aggregated scores of the dataframe for the trend line, built from the column if not given
+    mode:str
+        'scatter', 'binned' or 'hexbin'
+    freq:str
+        pandas frequency of the buckets in mode 'binned', e.g. 'D', 'W', 'ME' (month end)
+    gridsize:int
+        amount of hexagons in x-direction in mode 'hexbin'
+    """
+    if mode not in ('scatter', 'binned', 'hexbin'):
+        raise ValueError(f"Unknown mode {mode}, use 'scatter', 'binned' or 'hexbin'")
+    if cube is None:
+        cube = ScoreCube(df, [column])
+
     plt.figure(figsize=(14, 7))
-    plt.scatter(df_filtered['Publication Date'], df_filtered[column], color='blue', alpha=0.5)
+    if mode == 'binned':
+        buckets = bucket_stats(df, start_year, end_year, column, freq)
+        plt.fill_between(buckets.index, buckets['lower'], buckets['upper'], color='blue', alpha=0.2)
+        plt.plot(buckets.index, buckets['mean'], 'o-', color='blue', markersize=3)
+        dates = buckets.index
+    else:
+        # Filter data between start_year and end_year and remove articles with a sentiment score of zero
+        df_filtered = df[
+            (df['Year'] >= start_year) &
+            (df['Year'] <= end_year) &
+            (df[column] != 0)
+        ]
+        if mode == 'hexbin':
+            plt.hexbin(mdates.date2num(df_filtered['Publication Date']), df_filtered[column], gridsize=gridsize, cmap='Blues', mincnt=1)
+            plt.colorbar(label='Articles')
+            plt.gca().xaxis_date()
+        else:
+            # Scatter plot with each article as a point
+            plt.scatter(df_filtered['Publication Date'], df_filtered[column], color='blue', alpha=0.5)
+        dates = df_filtered['Publication Date']
 
-    # Fit a polynomial trend line of degree 1 (linear trend line)
-    z = np.polyfit(mdates.date2num(df_filtered['Publication Date']), df_filtered[column], 1)  # linear regression
-    p = np.poly1d(z)
+    # linear trend line from the cube (a line needs only its end points, the band some more)
+    trend_dates = pd.date_range(dates.min(), dates.max(), periods=50)
+    trend, lower, upper = cube.trend_band(column, start_year, end_year, trend_dates)
 
     # Plotting the trend line
-    plt.plot(df_filtered['Publication Date'], p(mdates.date2num(df_filtered['Publication Date'])), "r--")
+    plt.plot(trend_dates, trend, "r--")
+    if mode == 'binned':
+        plt.fill_between(trend_dates, lower, upper, color='red', alpha=0.15)
 
     # Formatting the plot
     plt.title(f'Sentiment Score for {start_year}-{end_year}')
@@ -66,4 +324,4 @@ def show_plt_year(df,start_year, end_year, column='Sentiment_Score'):
     plt.grid(True)
     plt.tight_layout()
 
-    plt.show()
\ No newline at end of file
+    plt.show()
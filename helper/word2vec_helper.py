@@ -1,11 +1,26 @@
 
 import spacy
 from gensim.models import Word2Vec
+import gensim
 import string
+import os
+import json
+import tempfile
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+from helper.token_store import TokenStore
+from helper.corpus_helper import text_hashes, slice_mask
+from helper.instrumentation import Tracer
 
 nlp = spacy.load('de_core_news_sm')
 
+# hyperparameters of the Word2Vec model
+word2vec_params = {'vector_size': 100, 'window': 10, 'min_count': 2, 'workers': 4, 'epochs': 10, 'seed': 42}
+
+# trained models in memory, model key -> Word2Vec
+_models = {}
+
 def preprocess_text(text:str):
     ''' tokenize text and remove tokens of types is_stop,is_punct and not in string punctuation list
 
@@ -15,13 +30,221 @@ def preprocess_text(text:str):
     tokens = [token.lemma_.lower() for token in doc if not token.is_stop and not token.is_punct and token.text.strip() not in string.punctuation]
     return tokens
 
+def filter_slice(df:pd.DataFrame, newspaper:str, years:list|str) -> pd.DataFrame:
+    ''' filter for years and newspaper if asked for '''
+    return df[slice_mask(df['Newspaper'].to_numpy(), df['Year'].to_numpy(), newspaper, years)]
+
+def model_key(df:pd.DataFrame, newspaper:str, years:list|str, params:dict, token_store:TokenStore=None, corpus_file:bool=True) -> str:
+    ''' returns the cache key of a model: slice, hyperparameters, training mode and version of the texts of the slice
+
+    a changed article only invalidates the models of slices containing it,
+    the amount of worker threads is not part of the key
+    '''
+    params = {name: value for name, value in params.items() if name != 'workers'}
+    if token_store is not None:
+        hashes = token_store.text_hashes[token_store.rows(newspaper, years)]
+        tokens = f'store:{token_store.meta["model"]}'
+        # the file mode and the streamed corpus give different models with the same seed
+        mode = 'corpus_file' if corpus_file else 'stream'
+    else:
+        hashes = text_hashes(filter_slice(df, newspaper, years))
+        tokens = f'spacy:{nlp.meta["name"]}-{nlp.meta["version"]}'
+        mode = 'list'
+    key = {'newspaper': newspaper, 'years': years if years == 'ALL' else sorted(int(year) for year in years),
+           'params': params, 'tokens': tokens, 'mode': mode, 'gensim': gensim.__version__,
+           'texts': hashlib.sha1(hashes.tobytes()).hexdigest()}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:20]
+
+class StoreSentences():
+    """ restartable iterable over the articles of a token store, one token list per article
+
+    Nothing is materialized, Word2Vec iterates once for the vocabulary and once per epoch.
+    Articles longer than max_length tokens are split (Word2Vec ignores words after 10000 per sentence).
+    """
+
+    def __init__(self, token_store:TokenStore, rows, max_length:int=10000):
+        self.token_store = token_store
+        self.rows = rows
+        self.max_length = max_length
+
+    def __iter__(self):
+        for row in self.rows:
+            tokens = self.token_store.word2vec_tokens(row)
+            for start in range(0, len(tokens), self.max_length):
+                yield tokens[start:start + self.max_length]
+
+def write_corpus_file(token_store:TokenStore, rows, path:str, max_length:int=10000) -> str:
+    """ writes the articles as gensim LineSentence file (one article per line, tokens separated by spaces)
+
+    Parameters
+    ----------
+    token_store: TokenStore
+        the tokens of the corpus
+    rows:
+        the article numbers
+    path:str
+        the file to write
+    max_length:int
+        longer articles are split into several lines
+
+    Returns
+    -------
+    str
+        the path of the file
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        for tokens in StoreSentences(token_store, rows, max_length):
+            # spaces would split a token into several words
+            file.write(' '.join(token.replace(' ', '_') for token in tokens))
+            file.write('\n')
+    return path
+
+def check_token_store(df:pd.DataFrame, token_store:TokenStore):
+    ''' raises a ValueError if the token store was not built from the texts of the dataframe '''
+    if token_store is not None and not token_store.matches(df):
+        raise ValueError('The token store does not contain the texts of the dataframe')
+
+def _fit(df:pd.DataFrame, newspaper:str, years:list|str, token_store:TokenStore, params:dict, work_dir:str=None, corpus_file:bool=True) -> Word2Vec:
+    """ trains the Word2Vec model of a slice
+
+    With a token store the articles are streamed: either written to a temporary LineSentence file
+    (corpus_file, gensim's multi-worker file mode, in work_dir or the temp directory) or iterated by StoreSentences,
+    so memory stays constant.
+    Without a token store the texts are tokenized by spaCy into a list first.
+    """
+    tracer = Tracer.getInstance()
+    if token_store is None:
+        # tokenize the texts
+        with tracer.span('word2vec.tokenize', newspaper=newspaper, years=years) as span:
+            processed_corpus = filter_slice(df, newspaper, years)['Extracted Text'].apply(preprocess_text).tolist()
+            span['articles'] = len(processed_corpus)
+        with tracer.span('word2vec.train', newspaper=newspaper, years=years, mode='list'):
+            return Word2Vec(processed_corpus, **params)
+
+    rows = token_store.rows(newspaper, years)
+    if not corpus_file:
+        with tracer.span('word2vec.train', newspaper=newspaper, years=years, mode='stream', articles=len(rows)):
+            return Word2Vec(StoreSentences(token_store, rows), **params)
+
+    handle, corpus_path = tempfile.mkstemp(suffix='.corpus.txt', dir=work_dir)
+    os.close(handle)
+    try:
+        with tracer.span('word2vec.corpus_file', newspaper=newspaper, years=years, articles=len(rows)):
+            write_corpus_file(token_store, rows, corpus_path)
+        with tracer.span('word2vec.train', newspaper=newspaper, years=years, mode='corpus_file', articles=len(rows)):
+            return Word2Vec(corpus_file=corpus_path, **params)
+    finally:
+        os.remove(corpus_path)
+
+def _train_model(args:tuple) -> str:
+    ''' trains and stores one model, runs in a worker process of train_models '''
+    texts, store_directory, newspaper, years, params, path, corpus_file = args
+    if store_directory is not None:
+        model = _fit(None, newspaper, years, TokenStore(store_directory), params, os.path.dirname(path), corpus_file)
+    else:
+        model = Word2Vec([preprocess_text(text) for text in texts], **params)
+    model.save(path)
+    return path
+
+def get_model(df:pd.DataFrame, newspaper:str, years:list|str, token_store:TokenStore=None, cache_dir:str='word2vec_cache', params:dict=None, corpus_file:bool=True) -> Word2Vec:
+    """ Returns the Word2Vec model of a slice of the corpus
+
+        The model is taken from memory, from the cache directory or trained (and stored) if not found
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe to work with
+        newspaper:str
+            either a valid newspaper or 'ALL'
+        years:list|str
+            either a list of years [2012,2013]  or 'ALL'
+        token_store: TokenStore
+            if given, the tokens are read from the store (built from the same dataframe) instead of running spaCy
+        cache_dir: str
+            directory of the stored models, None: keep models in memory only
+        params: dict
+            hyperparameters of Word2Vec, default: word2vec_params
+        corpus_file: bool
+            train from a LineSentence file written from the token store (else stream the store)
+    """
+    check_token_store(df, token_store)
+    params = dict(word2vec_params if params is None else params)
+    key = model_key(df, newspaper, years, params, token_store, corpus_file)
+    if key in _models:
+        return _models[key]
+
+    path = os.path.join(cache_dir, f'{key}.model') if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        model = Word2Vec.load(path)
+    else:
+        # train the Word2Vec-model
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        model = _fit(df, newspaper, years, token_store, params, cache_dir, corpus_file)
+        if path is not None:
+            model.save(path)
+    _models[key] = model
+    return model
+
+def train_models(df:pd.DataFrame, slices:list, token_store:TokenStore=None, cache_dir:str='word2vec_cache', params:dict=None, processes:int=None, corpus_file:bool=True):
+    """ Trains the models of all slices not cached yet, in parallel processes
+
+        Every process trains one slice with workers = cores / processes threads,
+        the models are stored in the cache directory and loaded into memory.
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            the dataframe to work with
+        slices: list
+            list of (newspaper, years), e.g. [('TAZ', 'ALL'), ('ALL', [2015])]
+        token_store: TokenStore
+            if given, the worker processes read their tokens from the store
+        cache_dir: str
+            directory of the stored models
+        params: dict
+            hyperparameters of Word2Vec, default: word2vec_params
+        processes: int
+            amount of worker processes, default: amount of missing slices (max amount of cores)
+        corpus_file: bool
+            train from a LineSentence file written from the token store (else stream the store)
+    """
+    check_token_store(df, token_store)
+    params = dict(word2vec_params if params is None else params)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    missing = {}
+    for newspaper, years in slices:
+        key = model_key(df, newspaper, years, params, token_store, corpus_file)
+        path = os.path.join(cache_dir, f'{key}.model')
+        if key not in _models and not os.path.exists(path):
+            missing[key] = (newspaper, years, path)
+    if missing:
+        cpu_count = os.cpu_count() or 1
+        if processes is None:
+            processes = min(len(missing), cpu_count)
+        worker_params = dict(params, workers=max(1, cpu_count // processes))
+        tasks = []
+        for newspaper, years, path in missing.values():
+            texts = None if token_store is not None else filter_slice(df, newspaper, years)['Extracted Text'].tolist()
+            tasks.append((texts, token_store.directory if token_store is not None else None, newspaper, years, worker_params, path, corpus_file))
+        print(f"Training {len(tasks)} models in {processes} processes")
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            list(executor.map(_train_model, tasks))
+
+    for newspaper, years in slices:
+        get_model(df, newspaper, years, token_store, cache_dir, params, corpus_file)
+
 # input for all newspapers/years: instead of specific newspaper or year(s), give 'ALL'
-def find_similar_words( df:pd.DataFrame,newspaper:str, years:list|str, word:str, top_n=10):
+def find_similar_words( df:pd.DataFrame,newspaper:str, years:list|str, word:str|list, top_n=10, token_store:TokenStore=None, cache_dir:str='word2vec_cache'):
     """ Returns similar words detected by Word2Vec
 
         Filtering the corpus (given as Dataframe) by newspaper and/or year
 
-        Applies Word2Vec on the filtered corpus for the given search word
+        Applies Word2Vec on the filtered corpus for the given search word.
+        The model of the slice is trained once and cached (see get_model), so further
+        search words of the same slice need no training.
 
         Parameters
         ----------
@@ -31,34 +254,29 @@ def find_similar_words( df:pd.DataFrame,newspaper:str, years:list|str, word:str,
             either a valid newspaper or 'ALL'
         years:list|str
             either a list of years [2012,2013]  or 'ALL'
+        word:str|list
+            the search word or a list of search words
         top_n : int or None, optional
             Number of top-N similar keys to return, when `topn` is int. When `topn` is None,
             then similarities for all keys are returned.
+        token_store: TokenStore
+            if given, the tokens are read from the store (built from the same dataframe) instead of running spaCy
+        cache_dir: str
+            directory of the stored models, None: keep models in memory only
+
 
-            
         Returns
         -------
         list of (str, float) or numpy.array
             When `topn` is int, a sequence of (key, similarity) is returned.
             When `topn` is None, then similarities for all keys are returned as a
             one-dimensional numpy array with the size of the vocabulary.
+            For a list of search words a dictionary search word -> result is returned
 
     """
-    # filter for years and newspaper if asked for
-    if newspaper != 'ALL':
-        filtered_df = df[df['Newspaper'] == newspaper]
-    else:
-        filtered_df = df
-
-    if years != 'ALL':
-        filtered_df = filtered_df[filtered_df['Year'].isin(years)]
-
-    # tokenize the texts
-    processed_corpus = filtered_df['Extracted Text'].apply(preprocess_text).tolist()
-
-    # train the Word2Vec-model
-    model = Word2Vec(processed_corpus, vector_size=100, window=10, min_count=2, workers=4, epochs=10,  seed=42)
+    model = get_model(df, newspaper, years, token_store, cache_dir)
 
     # find the 10 most similar words
-    similar_words = model.wv.most_similar(word, topn=top_n)
-    return similar_words
\ No newline at end of file
+    if isinstance(word, str):
+        return model.wv.most_similar(word, topn=top_n)
+    return {w: model.wv.most_similar(w, topn=top_n) for w in word}